@@ -0,0 +1,175 @@
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import FileReader
+import LoadCsvFiles
+import SchemaMetadata
+import SqlBatches
+
+
+def usage():
+    print('''\
+    Benchmarks: Times the current and optimized paths of the scripts
+    Usage: Benchmarks [OPTIONS]
+         -h --help                  Display this usage message
+         -r --rows                  Rows of generated data per benchmark. Default 100000.
+    Example: Benchmarks -r 500000
+    ''')
+
+
+def get_args(opts):
+    rows = 100000
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit(3)
+        if opt in ('-r', '--rows'):
+            rows = int(arg)
+    return rows
+
+
+def show_timing(name, seconds, baseline):
+    # Show the time taken and the speed up over the baseline
+    print(f'    {name:<30}{seconds:10.3f}s{baseline / seconds:8.1f}x')
+
+
+def benchmark_conversions(row_count):
+    # CSV text for each type of column
+    samples = {
+        'int': [str(i) for i in range(row_count)],
+        'decimal': [f'{i}.{i % 100:02}' for i in range(row_count)],
+        'date': [f'2018-{i % 12 + 1:02}-{i % 28 + 1:02}' for i in range(row_count)],
+        'bit': ['1' if i % 2 else '0' for i in range(row_count)],
+        'varchar': [f'Student {i}' for i in range(row_count)],
+    }
+    print(f'Converting {row_count} values per type')
+    for type_name, values in samples.items():
+        rows = [[item] for item in values]
+        column = SchemaMetadata.Column('Value', type_name, 0, 0, 0, True, False)
+        table_info = SchemaMetadata.TableInfo('dbo', 'Benchmark', [column], [], False, [])
+        literal_converters = LoadCsvFiles.get_column_converters(table_info, ['Value'], True)
+        parameter_converters = LoadCsvFiles.get_column_converters(table_info, ['Value'], False)
+
+        # The current path parses every cell as a float
+        baseline = min(timeit.repeat(lambda: [[LoadCsvFiles.get_value(item) for item in row] for row in rows],
+                                     number=1, repeat=3))
+        literal = min(timeit.repeat(lambda: LoadCsvFiles.convert_rows(rows, literal_converters), number=1, repeat=3))
+        parameter = min(timeit.repeat(lambda: LoadCsvFiles.convert_rows(rows, parameter_converters),
+                                      number=1, repeat=3))
+        print(f'  {type_name}')
+        show_timing('get_value per cell', baseline, baseline)
+        show_timing('typed literal by column', literal, baseline)
+        show_timing('typed parameter by column', parameter, baseline)
+
+
+def split_lines_by_prefix(file_lines):
+    # The way RunSqlFiles split batches before SqlBatches
+    batches = []
+    script = ''
+    for line in file_lines:
+        if line.lower().startswith('go'):
+            batches.append(script)
+            script = ''
+        else:
+            script += line
+    batches.append(script)
+    return batches
+
+
+def benchmark_batches(line_count):
+    # A generated post-deployment script, with a GO every 1000 lines and one large final batch
+    lines = []
+    for i in range(line_count):
+        lines.append(f"INSERT INTO metric.MetricVariant (MetricVariantId, Name) VALUES ({i}, N'Variant [{i}] it''s')\n")
+        if i % 1000 == 999 and i < line_count // 2:
+            lines.append('GO\n')
+    size = sum(len(line) for line in lines)
+    print(f'Splitting a script of {len(lines)} lines, {size / 1048576:.1f} MB')
+
+    baseline = min(timeit.repeat(lambda: split_lines_by_prefix(lines), number=1, repeat=3))
+    tokenizer = min(timeit.repeat(lambda: list(SqlBatches.get_batches(lines)), number=1, repeat=3))
+    show_timing('startswith and +=', baseline, baseline)
+    show_timing('SqlBatches.get_batches', tokenizer, baseline)
+
+
+def get_lines_with_retry(file):
+    # The way RunSqlFiles read files before FileReader
+    try:
+        with open(file, 'r', encoding='utf-8-sig') as fp:
+            return list(fp.readlines())
+    except UnicodeDecodeError:
+        with open(file, 'r', encoding='utf-16') as fp:
+            return list(fp.readlines())
+
+
+def benchmark_file_reading(line_count):
+    # A directory of scripts, every other one saved as UTF-16 like SQL Server Management Studio does
+    directory = tempfile.mkdtemp()
+    try:
+        files = write_scripts(directory, ('utf-8-sig', 'utf-16'), line_count, '')
+        time_file_reading(files, 'half UTF-8 and half UTF-16', get_lines_with_retry, 'utf-8-sig then utf-16')
+        # Scripts saved as cp1252 with an accented name near the end. The retry reads each twice and then fails,
+        # so compare with reading them once as cp1252, the least any reader can do.
+        files = write_scripts(directory, ('cp1252',), line_count, "-- Revised by José\n")
+        time_file_reading(files, 'cp1252 with a late accented line', get_cp1252_lines, 'cp1252 given')
+    finally:
+        shutil.rmtree(directory)
+
+
+def write_scripts(directory, encodings, line_count, last_line):
+    # Write scripts of inserts in turn in each encoding, ending with the last line
+    files = []
+    lines_per_file = 1000
+    for index in range(max(line_count // lines_per_file, 2)):
+        encoding = encodings[index % len(encodings)]
+        files.append(os.path.join(directory, f'Script{index}.{encoding}.sql'))
+        with open(files[-1], 'w', encoding=encoding, newline='\r\n') as fp:
+            for i in range(lines_per_file):
+                fp.write(f"INSERT INTO metric.MetricVariant (MetricVariantId, Name) VALUES ({i}, N'Variant {i}')\n")
+            fp.write(last_line)
+    return files
+
+
+def get_cp1252_lines(file):
+    # Read a file whose encoding is known
+    with open(file, 'r', encoding='cp1252') as fp:
+        return fp.readlines()
+
+
+def time_file_reading(files, description, get_baseline_lines, baseline_name):
+    size = sum(os.path.getsize(file) for file in files)
+    print(f'Reading {len(files)} scripts, {size / 1048576:.1f} MB, {description}')
+
+    # Split each file into batches, as RunSqlFiles does with the lines
+    baseline = min(timeit.repeat(lambda: [list(SqlBatches.get_batches(get_baseline_lines(file)))
+                                          for file in files], number=1, repeat=3))
+    reader = min(timeit.repeat(lambda: [list(SqlBatches.get_batches(FileReader.get_lines(file)))
+                                        for file in files], number=1, repeat=3))
+    show_timing(baseline_name, baseline, baseline)
+    show_timing('FileReader.get_lines', reader, baseline)
+
+
+def main(argv):
+    print('Running main.')
+
+    # Get command line options
+    try:
+        opts, args = getopt.getopt(argv, 'hr:', ['help', 'rows='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    # Get arguments
+    row_count = get_args(opts)
+
+    # Run the benchmarks
+    benchmark_conversions(row_count)
+    benchmark_batches(row_count)
+    benchmark_file_reading(row_count)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
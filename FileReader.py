@@ -0,0 +1,58 @@
+import codecs
+import io
+
+# Bytes read from the start of a file to decide its encoding
+sniff_size = 65536
+# Byte order marks and their encodings, UTF-32 first because its little endian mark starts with UTF-16's
+byte_order_marks = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'),
+                    (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+
+
+def get_encoding(prefix, fallback='cp1252', rest=()):
+    # Files with a byte order mark use its encoding
+    for byte_order_mark, encoding in byte_order_marks:
+        if prefix.startswith(byte_order_mark):
+            return encoding
+    # Text without a mark that has a zero in every other byte is UTF-16
+    if prefix.count(0) * 4 > len(prefix):
+        return 'utf-16-le' if prefix[1::2].count(0) > prefix[0::2].count(0) else 'utf-16-be'
+    # Try decoding the start of the file and then the rest of it as utf, allowing a character cut off at the end.
+    # A byte that is not utf can come long after the start, so only the whole file decides.
+    try:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        decoder.decode(prefix, final=False)
+        for data in rest:
+            decoder.decode(data, final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        # Otherwise use the fallback, cp1252 is common on windows
+        return fallback
+
+
+def get_file_encoding(file, fallback='cp1252'):
+    # Read the start of the file and decide its encoding. A byte that is not utf after the start is left
+    # for the reader to find, so large files are not read an extra time.
+    with open(file, 'rb') as fp:
+        return get_encoding(fp.read(sniff_size), fallback)
+
+
+def get_data_encoding(data, fallback='cp1252'):
+    # Decide the encoding of bytes already read, without copying them
+    view = memoryview(data)
+    return get_encoding(data[:sniff_size], fallback, (view[sniff_size:],))
+
+
+def get_lines(file, encoding=None):
+    # Return the lines of the file, reading its bytes once. Without an encoding it is decided from all of the bytes
+    # in memory, so a byte that is not utf long after the start is found without reading the file again.
+    with open(file, 'rb') as fp:
+        data = fp.read()
+    return decode_lines(data, encoding)
+
+
+def decode_lines(data, encoding=None):
+    # Return the lines of bytes already read, deciding the encoding unless given
+    if encoding is None:
+        encoding = get_data_encoding(data)
+    with io.TextIOWrapper(io.BytesIO(data), encoding) as text:
+        return text.readlines()
@@ -0,0 +1,39 @@
+import FileReader
+import os
+import tempfile
+import unittest
+
+
+def write_file(data):
+    file = os.path.join(tempfile.mkdtemp(), 'Script.sql')
+    with open(file, 'wb') as fp:
+        fp.write(data)
+    return file
+
+
+class TestFileReader(unittest.TestCase):
+    def test_get_encoding(self):
+        text = "SELECT 'é'\r\nGO\r\n"
+        for encoding, expected in (('utf-8-sig', 'utf-8-sig'), ('utf-8', 'utf-8-sig'), ('utf-16', 'utf-16'),
+                                   ('utf-16-le', 'utf-16-le'), ('utf-16-be', 'utf-16-be'), ('utf-32', 'utf-32'),
+                                   ('cp1252', 'cp1252')):
+            self.assertEqual(expected, FileReader.get_encoding(text.encode(encoding)))
+
+    def test_get_lines(self):
+        for encoding in ('utf-8-sig', 'utf-16', 'cp1252'):
+            file = write_file("SELECT 'é'\r\nGO\rSELECT 2\nSELECT 3".encode(encoding))
+            self.assertEqual(["SELECT 'é'\n", 'GO\n', 'SELECT 2\n', 'SELECT 3'], list(FileReader.get_lines(file)))
+
+    def test_get_encoding_late_byte(self):
+        data = ('x,y\n' * 20000 + 'café,z\n').encode('cp1252')
+        self.assertEqual('utf-8-sig', FileReader.get_file_encoding(write_file(data)))
+        self.assertEqual('cp1252', FileReader.get_data_encoding(data))
+        self.assertEqual('café,z\n', list(FileReader.get_lines(write_file(data)))[-1])
+        self.assertEqual('café,z\n', list(FileReader.decode_lines(data))[-1])
+
+    def test_get_lines_empty_file(self):
+        self.assertEqual([], list(FileReader.get_lines(write_file(b''))))
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TestFileReader)
+unittest.TextTestRunner(verbosity=2).run(suite)
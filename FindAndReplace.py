@@ -1,21 +1,18 @@
 import re
+import FileReader
 
 start_at = 2683
 increment_by = 10000 - 2683
 
 
 def find_lines_in_file(file, file_encoding, pattern, process_match):
-    # Open file for reading
-    with open(file, 'r', encoding=file_encoding) as fp:
-        print('File found ' + file)
-        # Get file contents into list
-        file_contents = fp.readlines()
-        # For each line in file
-        for line in file_contents:
-            # Search for the pattern
-            match_object = re.search(pattern, line, flags=0)
-            # Call function to process match
-            process_match(match_object)
+    print('File found ' + file)
+    # For each line in file, reading it once
+    for line in FileReader.get_lines(file, file_encoding):
+        # Search for the pattern
+        match_object = re.search(pattern, line, flags=0)
+        # Call function to process match
+        process_match(match_object)
 
 
 def replace_lines_in_file(file, file_encoding, pattern, process_match):
@@ -87,16 +84,12 @@ def main():
     # pattern = r'([\s]+' + re.escape('<') + 'IdentificationCode' + re.escape('>') + ')([\d]{8})'
     show = False
 
-    try:
-        if show:
-            find_lines_in_file(file_name, 'utf-8-sig', pattern, show_match)
-        else:
-            replace_lines_in_file(file_name, 'utf-8-sig', pattern, update_match)
-    except UnicodeDecodeError:
-        if show:
-            find_lines_in_file(file_name, 'utf-16', pattern, show_match)
-        else:
-            replace_lines_in_file(file_name, 'utf-16', pattern, update_match)
+    # Decide the encoding once from the start of the file
+    file_encoding = FileReader.get_file_encoding(file_name)
+    if show:
+        find_lines_in_file(file_name, file_encoding, pattern, show_match)
+    else:
+        replace_lines_in_file(file_name, file_encoding, pattern, update_match)
 
 
 if __name__ == '__main__':
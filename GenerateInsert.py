@@ -1,6 +1,7 @@
 import getopt
 import os
 import pyodbc
+import SchemaMetadata
 import sys
 
 
@@ -54,15 +55,13 @@ def get_schema_and_table_name(table):
     return schema, table_name
 
 
-def get_has_identity(cursor, table):
-    # Get has identity sql for table
-    identity_statement = 'SELECT OBJECTPROPERTY(OBJECT_ID(\'' + table + '\'), \'TableHasIdentity\') AS HasIdentity'
-    # Show has identity sql
-    print(identity_statement)
-    # Execute has identity
-    has_identity = cursor.execute(identity_statement).fetchone()
-    # Print and return result
-    return has_identity[0]
+def get_has_identity(cursor, server, database, table):
+    # Get the table from the shared schema metadata
+    table_info = SchemaMetadata.get_table(SchemaMetadata.get_schema_metadata(cursor, server, database), table)
+    if table_info is None:
+        raise ValueError(f'No table for {table} was found.')
+    # Return result
+    return table_info.has_identity
 
 
 def write_inserts_to_file(columns, has_identity, path, results, schema, table_name):
@@ -168,7 +167,7 @@ def main(argv):
     print(columns)
 
     # Determine if the table has an identity column
-    has_identity = get_has_identity(cursor, table)
+    has_identity = get_has_identity(cursor, server, database, table)
     print(has_identity)
 
     # Commit and transactions and close the connection
@@ -1,8 +1,51 @@
+import collections
+import contextlib
 import csv
+import datetime
+import decimal
 import getopt
+import hashlib
+import itertools
+import json
+import queue
+import re
+import sqlite3
 import sys
+import threading
+import time
 import os
 import pyodbc
+import FileReader
+import SchemaMetadata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Rows fetched per round trip when reading existing keys
+fetch_batch_size = 5000
+# Rows per key lookup when the keys for a table do not fit in memory
+lookup_batch_size = 500
+# Rows sent per executemany when staging rows for a MERGE
+stage_batch_size = 5000
+# Staging table column numbering the rows in file order, so the last of the rows with the same key is merged
+stage_row_column = 'LoadCsvFilesRow'
+# Most parameters SQL Server accepts in one statement, less a margin
+max_parameters = 2000
+
+# SQL types by how CSV text is converted for them
+integer_types = {'tinyint', 'smallint', 'int', 'bigint'}
+decimal_types = {'decimal', 'numeric', 'money', 'smallmoney'}
+float_types = {'float', 'real'}
+bit_types = {'bit'}
+unicode_types = {'nchar', 'nvarchar', 'ntext', 'sysname', 'xml'}
+text_types = {'char', 'varchar', 'text', 'uniqueidentifier', 'date', 'time', 'datetime', 'datetime2',
+              'smalldatetime', 'datetimeoffset'}
+integer_pattern = re.compile(r'^\s*[-+]?\d+\s*$')
+decimal_pattern = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+bit_values = {'1': True, '0': False, 'true': True, 'false': False}
+bit_literals = {'1': '1', '0': '0', 'true': '1', 'false': '0'}
+# Chunks read and converted ahead of the loader when parsing in worker processes
+pipeline_depth = 4
+# Seconds between progress lines
+progress_interval = 5
 
 
 def usage():
@@ -16,7 +59,36 @@ def usage():
          -d --database              Required. Database name
          -u --user                  Required. User name
          -w --password              Required. Password
-         -t --test                  Only display the statements that would be run. Do not run them.
+         -t --test                  Plan the load without changing the database. Compares a snapshot of each table
+                                    with its file and shows the inserts, updates and unchanged rows.
+         -l --plan                  With --test, JSON file to write the plan to.
+         -g --plan-script           With --test, SQL file to write the statements that would be run to.
+         -b --bulk                  Stage each file in a temp table and apply one MERGE per table.
+         -q --parameterized         Build one parameterized insert and update per table and run the rows in batches.
+         -k --key-limit             Most primary keys to hold in memory per table. Default 1000000.
+                                    Larger tables look up keys in batches.
+         -c --chunk-size            Rows read from a file at a time. Default 10000.
+         -n --workers               Tables loaded at the same time, each on its own connection. Default 1.
+         -x --transaction           table: commit each table when it is loaded.
+                                    all: commit every table at the end, or roll back every table if one fails.
+                                    Default all.
+         -m --schema-cache          File to cache table metadata in between runs.
+         -r --refresh-schema        Read table metadata from the database even if it is cached.
+         -i --manifest              SQLite file recording a hash of each file and row that was loaded.
+                                    Unchanged files are skipped and only changed rows are sent.
+         -e --delete-missing        Delete rows recorded in the manifest that are no longer in the files.
+         -o --commit-every          With --transaction table, also commit after every chunk once this many rows
+                                    have been loaded since the last commit.
+         -j --checkpoint            With --transaction table, file recording the last committed table and chunk.
+                                    A run after a failure resumes from there. Removed when a run finishes.
+         -v --validate              Check the foreign keys of every file against the parent files and tables before
+                                    loading. Rows without a parent are shown by constraint and left out of the load.
+         -f --orphan-report         With --validate, JSON file to write the rows without a parent to.
+         -a --parse-workers         Processes converting rows by column type ahead of the loader, while each file is
+                                    read on a thread. Default 0, converting on the loader.
+         -y --metrics               JSON file to write rows, statements, round trips, timings and rows per second
+                                    for each table to.
+         -z --progress              Show a progress line for each table while it loads.
     Example: LoadCsvFiles -p D:\Projects\Indiana\Dashboards-Plugin-EWS\Database\Data\Dashboard\DashboardTypes -s . \
 -d IN_EdFi_Dashboard -u edfiPService -w edfiPService
     Example: LoadCsvFiles \
@@ -32,6 +104,25 @@ def get_args(opts):
     user = None
     password = None
     test = False
+    plan_file = None
+    plan_script = None
+    bulk = False
+    parameterized = False
+    key_limit = 1000000
+    chunk_size = 10000
+    workers = 1
+    transaction = 'all'
+    schema_cache = None
+    refresh_schema = False
+    manifest_file = None
+    delete_missing = False
+    commit_every = None
+    checkpoint_file = None
+    validate = False
+    orphan_report = None
+    parse_workers = 0
+    metrics_file = None
+    progress = False
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             usage()
@@ -48,7 +139,47 @@ def get_args(opts):
             password = arg
         if opt in ('-t', '--test'):
             test = True
-    return database, password, path, server, user, test
+        if opt in ('-l', '--plan'):
+            plan_file = arg
+        if opt in ('-g', '--plan-script'):
+            plan_script = arg
+        if opt in ('-b', '--bulk'):
+            bulk = True
+        if opt in ('-q', '--parameterized'):
+            parameterized = True
+        if opt in ('-k', '--key-limit'):
+            key_limit = int(arg)
+        if opt in ('-c', '--chunk-size'):
+            chunk_size = int(arg)
+        if opt in ('-n', '--workers'):
+            workers = int(arg)
+        if opt in ('-x', '--transaction'):
+            transaction = arg
+        if opt in ('-m', '--schema-cache'):
+            schema_cache = arg
+        if opt in ('-r', '--refresh-schema'):
+            refresh_schema = True
+        if opt in ('-i', '--manifest'):
+            manifest_file = arg
+        if opt in ('-e', '--delete-missing'):
+            delete_missing = True
+        if opt in ('-o', '--commit-every'):
+            commit_every = int(arg)
+        if opt in ('-j', '--checkpoint'):
+            checkpoint_file = arg
+        if opt in ('-v', '--validate'):
+            validate = True
+        if opt in ('-f', '--orphan-report'):
+            orphan_report = arg
+        if opt in ('-a', '--parse-workers'):
+            parse_workers = int(arg)
+        if opt in ('-y', '--metrics'):
+            metrics_file = arg
+        if opt in ('-z', '--progress'):
+            progress = True
+    return database, password, path, server, user, test, plan_file, plan_script, bulk, parameterized, key_limit, \
+        chunk_size, workers, transaction, schema_cache, refresh_schema, manifest_file, delete_missing, commit_every, \
+        checkpoint_file, validate, orphan_report, parse_workers, metrics_file, progress
 
 
 def get_files_from_path(path):
@@ -60,17 +191,42 @@ def get_files_from_path(path):
     return full_list
 
 
-def get_rows_from_file(file, file_encoding):
+def get_headers_from_file(file, file_encoding):
+    # Open the file for reading
+    with open(file, 'r', encoding=file_encoding, newline='') as fp:
+        # Get a CSV reader and return the headers from the file
+        reader = csv.reader(fp, delimiter=',', quotechar='"')
+        return next(reader, None)
+
+
+def get_chunks_from_file(file, file_encoding, chunk_size):
+    # Yield the rows a chunk at a time so only one chunk is held in memory
+    rows_read = 0
+    try:
+        for chunk in read_chunks_from_file(file, file_encoding, chunk_size, 0):
+            rows_read += len(chunk)
+            yield chunk
+    except UnicodeDecodeError:
+        # The encoding was decided from the start of the file. If a later byte is not utf then read the file
+        # again as cp1252, leaving out the rows already read.
+        if file_encoding != 'utf-8-sig':
+            raise
+        print(f'{file} is not utf-8 after its start, reading it again as cp1252')
+        yield from read_chunks_from_file(file, 'cp1252', chunk_size, rows_read)
+
+
+def read_chunks_from_file(file, file_encoding, chunk_size, skip):
     # Open the file for reading
-    with open(file, 'r', encoding=file_encoding) as fp:
-        # Get a CSV reader
+    with open(file, 'r', encoding=file_encoding, newline='') as fp:
+        # Get a CSV reader and skip the headers and the rows to leave out
         reader = csv.reader(fp, delimiter=',', quotechar='"')
-        # Get the headers from the file
-        headers = next(reader, None)
-        # Read the data from the CSV reader
-        data_read = [row for row in reader]
-    # Return the headers and data
-    return headers, data_read
+        next(reader, None)
+        next(itertools.islice(reader, skip, skip), None)
+        while True:
+            chunk = list(itertools.islice(reader, chunk_size))
+            if not chunk:
+                break
+            yield chunk
 
 
 def get_table_name(file):
@@ -86,116 +242,1177 @@ def get_table_name(file):
     return table
 
 
-def run_data(table, headers, data, cursor, should_execute):
-    # Get schema information
-    table_info = cursor.tables(table=table).fetchone()
+def get_table_info(table, metadata):
+    # Get schema information, identity indicator and primary key columns from the schema metadata
+    table_info = SchemaMetadata.get_table(metadata, table)
     if table_info is None:
         raise ValueError(f'No table for {table} was found.')
-    schema_name = table_info.table_schem
+    return table_info
+
+
+def get_dependencies(metadata, tables):
+    # Match table names without regard to case, as SQL Server does
+    table_names = {table.lower(): table for table in tables}
+    dependencies = {table: set() for table in tables}
+    for table in tables:
+        # Missing tables are reported when they are loaded
+        table_info = SchemaMetadata.get_table(metadata, table)
+        if table_info is None:
+            continue
+        # Get the tables referenced by foreign keys on this table
+        for foreign_key in table_info.foreign_keys:
+            parent = table_names.get(foreign_key.referenced_table.lower())
+            # Only tables being loaded matter, and rows referencing their own table are retried in run_data
+            if parent is not None and parent != table:
+                dependencies[table].add(parent)
+    return dependencies
+
+
+def get_load_levels(tables, dependencies):
+    # Sort tables so parents are loaded before children. Each level only depends on earlier levels.
+    levels = []
+    loaded = set()
+    remaining = list(tables)
+    while remaining:
+        level = [table for table in remaining if dependencies[table] <= loaded]
+        # If no table can be loaded then the rest are in or depend on a cycle
+        if not level:
+            return levels, remaining
+        levels.append(level)
+        loaded.update(level)
+        remaining = [table for table in remaining if table not in loaded]
+    return levels, []
+
+
+def get_cycle_tables(tables, dependencies):
+    # Remove tables no other remaining table depends on until only the tables in cycles are left
+    cycle = list(tables)
+    while True:
+        parents = set().union(*(dependencies[table] for table in cycle))
+        trimmed = [table for table in cycle if table in parents]
+        if len(trimmed) == len(cycle):
+            return cycle
+        cycle = trimmed
+
+
+def get_table_groups(levels, dependencies):
+    # Group tables connected by foreign keys, keeping the load order within each group
+    ordered = [table for level in levels for table in level]
+    group_of = {table: {table} for table in ordered}
+    for table in ordered:
+        for parent in dependencies[table]:
+            if group_of[parent] is not group_of[table]:
+                merged = group_of[table] | group_of[parent]
+                for member in merged:
+                    group_of[member] = merged
+    groups = {}
+    for table in ordered:
+        groups.setdefault(id(group_of[table]), []).append(table)
+    return list(groups.values())
+
+
+def get_connection_pool(connect, size):
+    # Open a connection for each worker
+    pool = queue.Queue()
+    for _ in range(size):
+        pool.put(connect())
+    return pool
+
+
+def close_connection_pool(pool, commit):
+    # Commit or roll back each connection and close it
+    while not pool.empty():
+        connection = pool.get()
+        if commit:
+            connection.commit()
+        else:
+            connection.rollback()
+        connection.close()
+
+
+def load_tables_on_pool(pool, load, tables, commit, delete=None):
+    # Take a connection from the pool and load the tables in order on it
+    connection = pool.get()
+    try:
+        cursor = connection.cursor()
+        failed_statements = []
+        for table in tables:
+            failed_statements += run_table(connection, cursor, load, table, commit)
+        # Delete rows that are no longer in the files, children first
+        if delete is not None:
+            for table in reversed(tables):
+                failed_statements += run_table(connection, cursor, delete, table, commit)
+        return failed_statements
+    finally:
+        pool.put(connection)
+
+
+def run_table(connection, cursor, action, table, commit):
+    # Run the action for the table
+    try:
+        failed_statements = action(table, cursor)
+    except Exception:
+        if commit:
+            connection.rollback()
+        raise
+    # If committing per table, commit this table
+    if commit:
+        connection.commit()
+    return failed_statements
+
+
+def load_levels(levels, dependencies, pool, load, workers, transaction, delete=None):
+    # Returns the failed statements and the errors by table
+    failed_statements = []
+    errors = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if transaction == 'table':
+            # Load the tables in each level at the same time, each committed when it is loaded,
+            # then delete rows that are no longer in the files, children first
+            phases = [(level, load) for level in levels]
+            if delete is not None:
+                phases += [(level, delete) for level in reversed(levels)]
+            for level, action in phases:
+                futures = [(table, executor.submit(load_tables_on_pool, pool, action, [table], True))
+                           for table in level]
+                for table, future in futures:
+                    try:
+                        failed_statements += future.result()
+                    except Exception as e:
+                        errors[table] = e
+        else:
+            # Uncommitted rows are only visible on the connection that wrote them, so tables connected
+            # by foreign keys are loaded in order on one connection and unconnected groups at the same time
+            groups = get_table_groups(levels, dependencies)
+            futures = [(tables, executor.submit(load_tables_on_pool, pool, load, tables, False, delete))
+                       for tables in groups]
+            for tables, future in futures:
+                try:
+                    failed_statements += future.result()
+                except Exception as e:
+                    errors[', '.join(tables)] = e
+    return failed_statements, errors
+
+
+def load_table(table_info, file, file_encoding, cursor, should_execute, bulk, parameterized, key_limit, chunk_size,
+               manifest, plan, write_script, checkpoint, commit_every, checks, executor, metrics):
+    # Count the statements and round trips, and time them
+    cursor = MeteredCursor(cursor, metrics)
+
+    # Get the headers and a reader for chunks of rows from the file, timing the parsing.
+    # If converting in worker processes then also read the file on a thread while the database is busy.
+    headers = get_headers_from_file(file, file_encoding)
+    chunks = time_chunks(get_chunks_from_file(file, file_encoding, chunk_size), metrics)
+    if executor is not None:
+        chunks = read_ahead(chunks, pipeline_depth)
+
+    # If the file is unchanged since the last load then skip it, otherwise only send the rows that changed
+    if manifest is not None:
+        file_hash = get_file_hash(file)
+        if manifest.is_unchanged(table_info.table_name, file_hash):
+            print(file + ' is unchanged since the last load.')
+            return []
+        chunks = manifest.filter_chunks(table_info.table_name, headers, table_info.pk_columns, file_hash, chunks)
+
+    # If validation found rows whose foreign keys have no parent then leave them out
+    if checks:
+        chunks = filter_orphan_rows(chunks, checks)
+
+    # If resuming from a checkpoint then skip the table if it was loaded, or the chunks that were committed
+    start = 0
+    if checkpoint is not None and should_execute:
+        start = checkpoint.get_start(table_info.table_name, file)
+        if start is None:
+            print(file + ' was loaded before the last run stopped.')
+            return []
+        if start:
+            print(f'Resuming {file} from chunk {start}.')
+            chunks = itertools.islice(chunks, start, None)
+
+    # Convert the rows by column type, in worker processes if there are any
+    if should_execute:
+        chunks = convert_chunks(chunks, table_info, headers, not bulk and not parameterized, executor, metrics)
+    # Commit every so many rows, except when staging for a MERGE which needs every row
+    if should_execute and not bulk and (commit_every is not None or start):
+        chunks = commit_chunks(chunks, table_info.table_name, file, cursor, checkpoint, commit_every, start)
+
+    # If only testing then plan the load, otherwise apply the rows with one MERGE,
+    # with parameterized batches, or row by row
+    if not should_execute:
+        failed_statements = plan_table(table_info, headers, chunks, cursor, plan, write_script)
+    elif bulk:
+        failed_statements = run_data_bulk(table_info, headers, chunks, cursor, should_execute, metrics)
+    elif parameterized:
+        failed_statements = run_data_parameterized(
+            table_info, headers, chunks, cursor, should_execute, key_limit, metrics)
+    else:
+        failed_statements = run_data(table_info, headers, chunks, cursor, should_execute, key_limit, metrics)
+    metrics.count('failed', len(failed_statements))
+
+    # Only record the table in the manifest if every row was loaded
+    if manifest is not None and not failed_statements and not checks:
+        manifest.mark_loaded(table_info.table_name)
+    # Commit the table and record it as loaded in the checkpoint. If statements failed then the next run
+    # loads the whole table again, so the failed rows are retried.
+    if checkpoint is not None and should_execute:
+        cursor.connection.commit()
+        checkpoint.save(table_info.table_name, file, 0, not failed_statements)
+    return failed_statements
+
+
+class TableMetrics:
+    # Counts and timings for loading one table, shown as a progress line while it loads
+
+    def __init__(self, table, progress):
+        self.table = table
+        self.progress = progress
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(('rows_read', 'inserted', 'updated', 'failed', 'statements', 'round_trips'), 0)
+        self.seconds = dict.fromkeys(('parse', 'convert', 'execute'), 0.0)
+        self.start = self.last_progress = time.perf_counter()
+        self.end = None
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+        self.show_progress()
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.seconds[name] += seconds
+
+    def finish(self):
+        self.end = time.perf_counter()
+        self.show_progress(True)
+
+    def show_progress(self, force=False):
+        # Show a progress line every so often if asked for
+        if not self.progress:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            if not force and now - self.last_progress < progress_interval:
+                return
+            self.last_progress = now
+            counts = dict(self.counts)
+        print(f"Progress {self.table}: {counts['rows_read']} rows read, {counts['inserted']} inserted, "
+              f"{counts['updated']} updated, {counts['rows_read'] / max(now - self.start, 1e-9):.0f} rows/sec",
+              flush=True)
+
+    def summary(self):
+        # Counts, timings and throughput for the JSON summary
+        with self.lock:
+            elapsed = (self.end or time.perf_counter()) - self.start
+            summary = dict(self.counts)
+            summary['skipped'] = max(summary['rows_read'] - summary['inserted'] - summary['updated'], 0)
+            summary.update({name + '_seconds': round(seconds, 3) for name, seconds in self.seconds.items()})
+            summary['elapsed_seconds'] = round(elapsed, 3)
+            summary['rows_per_second'] = round(summary['rows_read'] / elapsed, 1) if elapsed else 0
+            return summary
+
+
+class MeteredCursor:
+    # Wraps a cursor to count the statements and round trips to the database, and time them
+
+    def __init__(self, cursor, metrics):
+        object.__setattr__(self, 'cursor', cursor)
+        object.__setattr__(self, 'metrics', metrics)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.cursor, name, value)
+
+    def execute(self, statement, *parameters):
+        return self.run(1, 1, self.cursor.execute, statement, *parameters)
+
+    def executemany(self, statement, parameter_rows):
+        # Fast executemany sends the rows in one parameter array, otherwise each row is a round trip
+        round_trips = 1 if getattr(self.cursor, 'fast_executemany', False) else len(parameter_rows)
+        return self.run(len(parameter_rows), round_trips, self.cursor.executemany, statement, parameter_rows)
+
+    def fetchmany(self, size):
+        return self.run(0, 1, self.cursor.fetchmany, size)
+
+    def run(self, statements, round_trips, action, *args):
+        started = time.perf_counter()
+        try:
+            result = action(*args)
+        finally:
+            self.metrics.add_time('execute', time.perf_counter() - started)
+            self.metrics.count('statements', statements)
+            self.metrics.count('round_trips', round_trips)
+        # Return this cursor in place of the wrapped one, so fetches through it are counted
+        return self if result is self.cursor else result
 
-    # Determine if the table has an identity column
-    has_identity = False
-    for row in cursor.columns(table_info.table_name):
-        if 'identity' in row.type_name:
-            has_identity = True
+
+def time_chunks(chunks, metrics):
+    # Time reading and parsing each chunk and count the rows read
+    chunks = iter(chunks)
+    while True:
+        started = time.perf_counter()
+        chunk = next(chunks, None)
+        metrics.add_time('parse', time.perf_counter() - started)
+        if chunk is None:
+            return
+        metrics.count('rows_read', sum(1 for row in chunk if row))
+        yield chunk
+
+
+def commit_chunks(chunks, table, file, cursor, checkpoint, commit_every, start):
+    # Count the chunks from the first one that was not committed before the last run stopped
+    row_count = 0
+    for index, (rows, converted_rows) in enumerate(chunks, start):
+        yield rows, converted_rows
+        # The chunk has been loaded when the next one is asked for, so commit and record it if it is time
+        row_count += len(rows)
+        if commit_every is not None and row_count >= commit_every:
+            cursor.connection.commit()
+            if checkpoint is not None:
+                checkpoint.save(table, file, index + 1, False)
+            row_count = 0
+
+
+def read_ahead(chunks, depth):
+    # Read chunks on a thread, holding at most depth of them until the loader asks for them
+    chunk_queue = queue.Queue(depth)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put_unless_stopped(chunk_queue, (chunk, None), stop):
+                    return
+            put_unless_stopped(chunk_queue, (None, None), stop)
+        except Exception as e:
+            put_unless_stopped(chunk_queue, (None, e), stop)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            chunk, error = chunk_queue.get()
+            if error is not None:
+                raise error
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # If the loader stops early then let the thread finish
+        stop.set()
+
+
+def put_unless_stopped(chunk_queue, item, stop):
+    # Wait for room in the queue, giving up if the loader stopped
+    while not stop.is_set():
+        try:
+            chunk_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def convert_chunks(chunks, table_info, headers, literal, executor, metrics):
+    # Pair the rows of each chunk with their converted values, skipping empty rows to prevent fails
+    if executor is None:
+        converters = get_column_converters(table_info, headers, literal)
+        for chunk in chunks:
+            rows = [row for row in chunk if row]
+            started = time.perf_counter()
+            converted_rows = convert_rows(rows, converters)
+            metrics.add_time('convert', time.perf_counter() - started)
+            yield rows, converted_rows
+        return
+
+    # Convert a few chunks ahead in the worker processes while the loader runs the current one
+    pending = collections.deque()
+    for chunk in chunks:
+        rows = [row for row in chunk if row]
+        pending.append((rows, executor.submit(convert_chunk, table_info, headers, literal, rows)))
+        if len(pending) >= pipeline_depth:
+            yield get_converted_chunk(pending.popleft(), metrics)
+    while pending:
+        yield get_converted_chunk(pending.popleft(), metrics)
+
+
+def get_converted_chunk(pending_chunk, metrics):
+    # Wait for a chunk to be converted and record the time the worker took
+    rows, future = pending_chunk
+    converted_rows, seconds = future.result()
+    metrics.add_time('convert', seconds)
+    return rows, converted_rows
+
+
+def convert_chunk(table_info, headers, literal, rows):
+    # Runs in a worker process, the converters are built there as they can not be pickled
+    started = time.perf_counter()
+    converted_rows = convert_rows(rows, get_column_converters(table_info, headers, literal))
+    return converted_rows, time.perf_counter() - started
+
+
+class LoadCheckpoint:
+    # Records the last committed chunk of each table, so a load that stops can resume from there
+
+    def __init__(self, file, server, database, chunk_size):
+        self.file = file
+        self.lock = threading.Lock()
+        self.database_key = SchemaMetadata.get_cache_key(server, database)
+        self.chunk_size = chunk_size
+        self.tables = {}
+        # Positions are only valid for the same database and chunk size
+        if os.path.exists(file):
+            with open(file, 'r', encoding='utf-8') as fp:
+                saved = json.load(fp)
+            if saved.get('database') == self.database_key and saved.get('chunk_size') == chunk_size:
+                self.tables = saved['tables']
+
+    def get_start(self, table, file):
+        # Return the chunk to start from, or None if the table was loaded
+        position = self.tables.get(table.lower())
+        # If there is no position or the file changed then start from the beginning
+        if position is None or position['file'] != get_file_stamp(file):
+            return 0
+        return None if position['complete'] else position['chunk']
+
+    def save(self, table, file, chunk, complete):
+        # Record the position and write the checkpoint file, replacing it in one step
+        with self.lock:
+            self.tables[table.lower()] = {'file': get_file_stamp(file), 'chunk': chunk, 'complete': complete}
+            with open(self.file + '.tmp', 'w', encoding='utf-8') as fp:
+                json.dump({'database': self.database_key, 'chunk_size': self.chunk_size, 'tables': self.tables}, fp)
+            os.replace(self.file + '.tmp', self.file)
+
+    def remove(self):
+        # The load finished, so the next run starts from the beginning
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+
+def get_file_stamp(file):
+    # Size and modified time, to tell if a file changed since the checkpoint
+    stat = os.stat(file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def validate_foreign_keys(tables, file_dictionary, metadata, cursor, chunk_size):
+    # Find the table each file loads so parent keys can be read from the parent files
+    file_tables = {}
+    for table in tables:
+        table_info = get_table_info(table, metadata)
+        file_tables[(table_info.schema_name + '.' + table_info.table_name).lower()] = table
+
+    # Check the tables in load order, so rows left out of a parent also leave out the rows that reference them
+    checks = {}
+    orphans = {}
+    database_keys = {}
+    referenced_keys = {}
+    for table in tables:
+        table_info = get_table_info(table, metadata)
+        file, file_encoding = file_dictionary[table]
+        headers = get_headers_from_file(file, file_encoding)
+        table_checks = []
+        for foreign_key in table_info.foreign_keys:
+            # Only check foreign keys whose columns are all in the file
+            if not all(column in headers for column in foreign_key.columns):
+                continue
+            # If the parent file leaves out the referenced columns then its new keys are not known until it is loaded
+            referenced = (foreign_key.referenced_schema + '.' + foreign_key.referenced_table).lower()
+            parent = file_tables.get(referenced)
+            if parent is not None:
+                parent_file, parent_encoding = file_dictionary[parent]
+                parent_headers = get_headers_from_file(parent_file, parent_encoding)
+                if not all(column in parent_headers for column in foreign_key.referenced_columns):
+                    continue
+            # Get the parent keys from the database with one query and from the valid rows of the parent file,
+            # once for each referenced table and columns. A table referencing itself is not validated yet,
+            # so its keys are read from every row and not kept for the tables that follow.
+            key_id = referenced, tuple(column.lower() for column in foreign_key.referenced_columns)
+            # The columns of a foreign key have the types of the columns it references
+            key_converters = get_key_converters(table_info, foreign_key.columns)
+            keys = referenced_keys.get(key_id)
+            if keys is None:
+                if key_id not in database_keys:
+                    database_keys[key_id] = get_referenced_keys(cursor, foreign_key, key_converters)
+                keys = set(database_keys[key_id])
+                if parent is not None:
+                    indexes = [parent_headers.index(column) for column in foreign_key.referenced_columns]
+                    for chunk in filter_orphan_rows(
+                            get_chunks_from_file(parent_file, parent_encoding, chunk_size), checks.get(parent)):
+                        keys.update(get_row_key(row, indexes, key_converters) for row in chunk if row)
+                if parent != table:
+                    referenced_keys[key_id] = keys
+            table_checks.append((foreign_key, [headers.index(column) for column in foreign_key.columns], keys,
+                                 key_converters))
+        if not table_checks:
+            continue
+
+        # Find the rows of the file with a foreign key that has no parent, grouped by constraint
+        row_number = 0
+        for chunk in get_chunks_from_file(file, file_encoding, chunk_size):
+            for row in chunk:
+                row_number += 1
+                if not row:
+                    continue
+                for foreign_key, indexes, keys, key_converters in table_checks:
+                    if not is_orphan(get_row_key(row, indexes, key_converters), keys):
+                        continue
+                    checks[table] = table_checks
+                    orphan = orphans.setdefault(foreign_key.name, {
+                        'table': table_info.schema_name + '.' + table_info.table_name,
+                        'referenced_table': foreign_key.referenced_schema + '.' + foreign_key.referenced_table,
+                        'columns': foreign_key.columns, 'rows': 0, 'examples': []})
+                    orphan['rows'] += 1
+                    if len(orphan['examples']) < 10:
+                        values = [row[index] if index < len(row) else '' for index in indexes]
+                        orphan['examples'].append({'row': row_number, 'values': values})
+    return checks, orphans
+
+
+def get_referenced_keys(cursor, foreign_key, key_converters):
+    # Stream the keys a foreign key can reference into a set
+    cursor.execute('SELECT DISTINCT ' + ', '.join(foreign_key.referenced_columns) + ' FROM ' +
+                   foreign_key.referenced_schema + '.' + foreign_key.referenced_table)
+    return fetch_keys(cursor, key_converters)
+
+
+def get_row_key(row, indexes, key_converters):
+    # Build a key from columns of a CSV row, treating missing columns as empty
+    return get_key([row[index] if index < len(row) else '' for index in indexes], key_converters)
+
+
+def is_orphan(key, keys):
+    # A foreign key with a null column is not checked by SQL Server
+    return None not in key and key not in keys
+
+
+def filter_orphan_rows(chunks, checks):
+    # Yield each chunk without the rows whose foreign keys have no parent
+    for chunk in chunks:
+        if checks:
+            chunk = [row for row in chunk if not row or not any(
+                is_orphan(get_row_key(row, indexes, key_converters), keys)
+                for _, indexes, keys, key_converters in checks)]
+        yield chunk
+
+
+def show_orphans(orphans):
+    # Show the rows left out of the load by constraint
+    for name, orphan in orphans.items():
+        print(f"{name}: {orphan['rows']} rows in {orphan['table']} ({', '.join(orphan['columns'])}) "
+              f"have no parent in {orphan['referenced_table']}")
+        for example in orphan['examples']:
+            print(f"    Row {example['row']}: {', '.join(example['values'])}")
+
+
+def plan_table(table_info, headers, chunks, cursor, plan, write_script):
+    # Get schema information, identity indicator and primary key columns
+    schema_name, table = table_info.schema_name, table_info.table_name
+    has_identity, pk_columns = table_info.has_identity, table_info.pk_columns
+    pk_indexes = [headers.index(pk) for pk in pk_columns]
+    converters = get_column_converters(table_info, headers, True)
+    key_converters = get_key_converters(table_info, headers)
+
+    # Snapshot the keys and values of the table with one streamed query
+    snapshot = {}
+    cursor.execute('SELECT ' + ', '.join(headers) + ' FROM ' + schema_name + '.' + table)
+    while True:
+        results = cursor.fetchmany(fetch_batch_size)
+        if not results:
             break
+        for result in results:
+            values = get_key(result, key_converters)
+            snapshot[tuple(values[index] for index in pk_indexes)] = values
+
+    # Compare the rows from the file with the snapshot
+    counts = {'inserts': 0, 'updates': 0, 'unchanged': 0}
+    statements = []
+    for rows in get_batches(chunks, lookup_batch_size):
+        literal_rows = convert_rows(rows, converters) if write_script is not None else rows
+        for row, literal_row in zip(rows, literal_rows):
+            values = get_key(row + [''] * (len(headers) - len(row)), key_converters)
+            key = tuple(values[index] for index in pk_indexes)
+            if key not in snapshot:
+                counts['inserts'] += 1
+                statement = get_insert_statement(headers, literal_row, schema_name, table)
+            elif snapshot[key] != values:
+                counts['updates'] += 1
+                _, statement = get_update_statement(
+                    headers, dict(zip(headers, literal_row)), schema_name, table, pk_columns)
+            else:
+                counts['unchanged'] += 1
+                continue
+            # Remember the row so a repeated row is compared with it
+            snapshot[key] = values
+            if write_script is not None:
+                statements.append(statement)
+
+    # Record the counts and write the statements for the table to the script
+    print(f'{schema_name}.{table}: {counts["inserts"]} inserts, {counts["updates"]} updates, '
+          f'{counts["unchanged"]} unchanged')
+    plan[schema_name + '.' + table] = counts
+    if write_script is not None and statements:
+        identity = 'SET IDENTITY_INSERT ' + schema_name + '.' + table
+        lines = [f'-- {schema_name}.{table}'] + ([identity + ' ON', 'GO'] if has_identity else []) + \
+            statements + ['GO'] + ([identity + ' OFF', 'GO'] if has_identity else [])
+        write_script('\n'.join(lines) + '\n')
+    return []
+
+
+def delete_missing_rows(table_info, cursor, should_execute, manifest):
+    # Delete the rows loaded before that are no longer in the file
+    schema_name, table, pk_columns = table_info.schema_name, table_info.table_name, table_info.pk_columns
+    converters = get_column_converters(table_info, pk_columns, True)
+    failed_statements = []
+    for key in manifest.get_missing_keys(table):
+        header_literal_dict = dict(zip(pk_columns, [converter(item) for converter, item in zip(converters, key)]))
+        delete = 'DELETE FROM ' + schema_name + '.' + table + get_where_clause(pk_columns, header_literal_dict)
+        print(delete)
+        try:
+            execute_cursor(cursor, delete, should_execute)
+        except pyodbc.IntegrityError:
+            # If it fails, other rows still reference it
+            failed_statements.append((delete, ()))
+
+    # Only record the table in the manifest if every missing row was deleted
+    if failed_statements:
+        manifest.discard(table)
+    return failed_statements
+
+
+def get_file_hash(file):
+    # Hash the contents of the file a block at a time
+    file_hash = hashlib.sha1()
+    with open(file, 'rb') as fp:
+        for block in iter(lambda: fp.read(1048576), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class LoadManifest:
+    # Records a hash of each file and of each row by primary key, so later loads only send what changed
+
+    def __init__(self, file, server, database):
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.database_key = SchemaMetadata.get_cache_key(server, database)
+        self.pending = {}
+        self.missing = {}
+        self.loaded = set()
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS LoadedFile (DatabaseKey TEXT, TableName TEXT, '
+                                    'FileHash TEXT, PRIMARY KEY (DatabaseKey, TableName))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS LoadedRow (DatabaseKey TEXT, TableName TEXT, '
+                                    'RowKey TEXT, RowHash TEXT, PRIMARY KEY (DatabaseKey, TableName, RowKey))')
+            self.connection.commit()
+
+    def is_unchanged(self, table, file_hash):
+        # Check the file hash recorded for the table
+        with self.lock:
+            result = self.connection.execute(
+                'SELECT FileHash FROM LoadedFile WHERE DatabaseKey = ? AND TableName = ?',
+                (self.database_key, table.lower())).fetchone()
+        return result is not None and result[0] == file_hash
+
+    def filter_chunks(self, table, headers, pk_columns, file_hash, chunks):
+        # Get the row hashes recorded for the table
+        with self.lock:
+            old_hashes = dict(self.connection.execute(
+                'SELECT RowKey, RowHash FROM LoadedRow WHERE DatabaseKey = ? AND TableName = ?',
+                (self.database_key, table.lower())))
+        new_hashes = {}
+        self.pending[table] = file_hash, new_hashes
+        pk_indexes = [headers.index(pk) for pk in pk_columns]
+
+        # Yield only the rows that are new or changed
+        for chunk in chunks:
+            changed = []
+            for row in chunk:
+                if not row:
+                    continue
+                key = '\x1f'.join(row[index] for index in pk_indexes)
+                new_hashes[key] = hashlib.sha1('\x1f'.join(row).encode('utf-8')).hexdigest()
+                if old_hashes.get(key) != new_hashes[key]:
+                    changed.append(row)
+            yield changed
 
-    # Get the primary key columns
-    pk_columns = [row.column_name for row in
-                  cursor.primaryKeys(table_info.table_name, table_info.table_cat, table_info.table_schem).fetchall()]
+        # Remember the rows that are no longer in the file
+        self.missing[table] = [key for key in old_hashes if key not in new_hashes]
 
+    def get_missing_keys(self, table):
+        # Return the primary key values of the rows that are no longer in the file
+        return [key.split('\x1f') for key in self.missing.get(table, [])]
+
+    def mark_loaded(self, table):
+        with self.lock:
+            self.loaded.add(table)
+
+    def discard(self, table):
+        with self.lock:
+            self.loaded.discard(table)
+
+    def save(self):
+        # Record the hashes of the tables that were loaded
+        with self.lock:
+            for table in self.loaded:
+                file_hash, row_hashes = self.pending[table]
+                self.connection.execute('DELETE FROM LoadedRow WHERE DatabaseKey = ? AND TableName = ?',
+                                        (self.database_key, table.lower()))
+                self.connection.executemany(
+                    'INSERT INTO LoadedRow (DatabaseKey, TableName, RowKey, RowHash) VALUES (?, ?, ?, ?)',
+                    ((self.database_key, table.lower(), key, row_hash) for key, row_hash in row_hashes.items()))
+                self.connection.execute('INSERT OR REPLACE INTO LoadedFile (DatabaseKey, TableName, FileHash) '
+                                        'VALUES (?, ?, ?)', (self.database_key, table.lower(), file_hash))
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def run_data(table_info, headers, chunks, cursor, should_execute, key_limit, metrics):
+    # Get schema information, identity indicator and primary key columns
+    schema_name, table = table_info.schema_name, table_info.table_name
+    has_identity, pk_columns = table_info.has_identity, table_info.pk_columns
+
+    # Get the existing primary keys, or None if there are too many to hold in memory
+    key_converters = get_key_converters(table_info, pk_columns)
+    existing_keys = get_existing_keys(cursor, schema_name, table, pk_columns, key_limit, key_converters)
+
+    # Turn on identity insert once for the whole table, it is turned off again even if a statement fails
+    with identity_insert(cursor, schema_name, table, has_identity, should_execute):
+        try_later = []
+        for rows, literal_rows in get_converted_batches(chunks, lookup_batch_size):
+            # Turn headers with row data and with SQL literals into key value pairs and store in dictionaries
+            chunk = [(dict(zip(headers, row)), dict(zip(headers, literal_row)))
+                     for row, literal_row in zip(rows, literal_rows)]
+            # If the keys are not in memory then look up the keys for this batch
+            chunk_keys = existing_keys
+            if chunk_keys is None:
+                chunk_keys = get_existing_keys_for_rows(
+                    cursor, schema_name, table, pk_columns, [header_literal_dict for _, header_literal_dict in chunk],
+                    key_converters)
+            try_later += run_rows(headers, chunk, chunk_keys, cursor, schema_name, table, pk_columns, should_execute,
+                                  metrics, key_converters)
+
+        # Try the failed statements again (rows referencing other rows in the same table)
+        return retry_statements(try_later, cursor, should_execute)
+
+
+def run_data_parameterized(table_info, headers, chunks, cursor, should_execute, key_limit, metrics):
+    # Get schema information, identity indicator and primary key columns
+    schema_name, table = table_info.schema_name, table_info.table_name
+    has_identity, pk_columns = table_info.has_identity, table_info.pk_columns
+    if not pk_columns:
+        raise ValueError(f'No primary key for {table} was found.')
+
+    # Build the insert and update statements once from the headers
+    update_columns = [item for item in headers if item not in pk_columns]
+    insert = get_parameterized_insert_statement(headers, schema_name, table)
+    update = get_parameterized_update_statement(update_columns, schema_name, table, pk_columns)
+    print(insert)
+    print(update)
+    # Get the positions of the key columns, and of the update parameters in the rows
+    pk_indexes = [headers.index(pk) for pk in pk_columns]
+    update_indexes = [headers.index(item) for item in update_columns] + pk_indexes
+
+    # Get the existing primary keys, or None if there are too many to hold in memory
+    key_converters = get_key_converters(table_info, pk_columns)
+    existing_keys = get_existing_keys(cursor, schema_name, table, pk_columns, key_limit, key_converters)
+    # Keep key lookups under the SQL Server parameter limit
+    batch_size = min(lookup_batch_size, max_parameters // len(pk_columns))
+
+    # Turn on identity insert once for the whole table, it is turned off again even if a statement fails
+    with identity_insert(cursor, schema_name, table, has_identity, should_execute):
+        try_later = []
+        for rows, parameter_rows in get_converted_batches(chunks, batch_size):
+            keys = [get_key([row[index] for index in pk_indexes], key_converters) for row in rows]
+            # If the keys are not in memory then look up the keys for this batch
+            chunk_keys = existing_keys
+            if chunk_keys is None:
+                chunk_keys = get_existing_keys_for_parameters(
+                    cursor, schema_name, table, pk_columns,
+                    [[row[index] for index in pk_indexes] for row in parameter_rows], key_converters)
+
+            # Split the rows into inserts and updates
+            inserts = []
+            updates = []
+            for row, key in zip(parameter_rows, keys):
+                if key in chunk_keys:
+                    # Only update if the table contains columns beyond the primary key
+                    if update_columns:
+                        updates.append([row[index] for index in update_indexes])
+                else:
+                    # Remember the key so a repeated row becomes an update
+                    chunk_keys.add(key)
+                    inserts.append(row)
+
+            # Run the inserts first, so a repeated row is updated after it is inserted
+            print(f'{schema_name}.{table}: {len(inserts)} inserts, {len(updates)} updates')
+            metrics.count('inserted', len(inserts))
+            metrics.count('updated', len(updates))
+            try_later += execute_batch(cursor, schema_name, table, insert, inserts, should_execute)
+            try_later += execute_batch(cursor, schema_name, table, update, updates, should_execute)
+
+        # Try the failed statements again (rows referencing other rows in the same table)
+        return retry_statements(try_later, cursor, should_execute)
+
+
+def run_rows(headers, chunk, chunk_keys, cursor, schema_name, table, pk_columns, should_execute, metrics,
+             key_converters):
     try_later = []
-    for row in data:
-        # Prevent fails on empty rows
-        if not row:
-            continue
-        # Turn headers and row data into key value paris and store in dictionary
-        header_data_dict = dict(zip(headers, row))
-        # Get a select statement to determine if row exists in table
-        select = get_select_statement(schema_name, table, pk_columns, header_data_dict)
-        # print(select)
-        # Run select statement
-        result = execute_cursor(cursor, select, True).fetchone()
+    for header_data_dict, header_literal_dict in chunk:
+        key = get_key([header_data_dict[pk] for pk in pk_columns], key_converters)
         # If row exists
-        if result:
+        if key in chunk_keys:
             # Get should update indicator and update statement
             # Should update indicator means the table contains rows (beyond the primary key) to be updated
-            should_update, update = get_update_statement(headers, header_data_dict, schema_name, table, pk_columns)
+            should_update, update = get_update_statement(headers, header_literal_dict, schema_name, table, pk_columns)
             # If should update
             if should_update:
                 print(update)
+                metrics.count('updated')
                 # Try the update
                 try:
                     execute_cursor(cursor, update, should_execute)
                 except pyodbc.IntegrityError:
                     # If it fails, supporting (foreign key) rows may not have been loaded yet,
                     # save it to try again later
-                    try_later.append(update)
+                    try_later.append((update, ()))
             # Else show there was nothing to update
             else:
                 print('Nothing to update: ' + update)
         # Else row does not exist
         else:
-            # If table has identity turn on identity insert
-            if has_identity:
-                execute_cursor(cursor, 'SET IDENTITY_INSERT ' + schema_name + '.' + table + ' ON', should_execute)
+            # Remember the key so a repeated row becomes an update
+            chunk_keys.add(key)
             # Get the insert statement
-            insert = get_insert_statement(headers, row, schema_name, table)
+            insert = get_insert_statement(headers, [header_literal_dict[item] for item in headers], schema_name, table)
             print(insert)
+            metrics.count('inserted')
             # Try the insert
             try:
                 execute_cursor(cursor, insert, should_execute)
             except pyodbc.IntegrityError:
                 # If it fails, supporting (foreign key) rows may not have been loaded yet,
                 # save it to try again later
-                try_later.append(insert)
-            finally:
-                # If table has identity turn off identity insert
-                if has_identity:
-                    execute_cursor(cursor, 'SET IDENTITY_INSERT ' + schema_name + '.' + table + ' OFF', should_execute)
-
-    # For each try later statement
-    for statement in try_later:
-        print('Trying again: ' + statement)
+                try_later.append((insert, ()))
+
+    # Return the statements to try again
+    return try_later
+
+
+def retry_statements(try_later, cursor, should_execute):
+    # For each try later statement and its parameters
+    still_failing = []
+    for statement, parameters in try_later:
+        print('Trying again: ' + get_statement_text(statement, parameters))
         # Try it again
         try:
-            execute_cursor(cursor, statement, should_execute)
-            # If it succeeds then remove it from the list
-            try_later.remove(statement)
+            execute_cursor(cursor, statement, should_execute, parameters)
         except pyodbc.IntegrityError as e:
-            # If it fails, print a fail statement
+            # If it fails, print a fail statement and keep it
             print('Statement Fail:')
             print(e)
+            still_failing.append((statement, parameters))
 
     # Return any statements that are still failing
-    return try_later
+    return still_failing
+
+
+@contextlib.contextmanager
+def identity_insert(cursor, schema_name, table, has_identity, should_execute):
+    # Only tables with an identity column need identity insert
+    if not has_identity:
+        yield
+        return
+
+    # Only one table per session can have identity insert on, so always turn it off at the end of the block
+    execute_cursor(cursor, 'SET IDENTITY_INSERT ' + schema_name + '.' + table + ' ON', should_execute)
+    try:
+        yield
+    finally:
+        execute_cursor(cursor, 'SET IDENTITY_INSERT ' + schema_name + '.' + table + ' OFF', should_execute)
+
+
+def get_batches(chunks, batch_size):
+    # Split chunks of rows into batches, skipping empty rows to prevent fails
+    for chunk in chunks:
+        rows = [row for row in chunk if row]
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
 
 
-def execute_cursor(cursor, statement, should_execute):
+def get_converted_batches(chunks, batch_size):
+    # Split chunks of rows and their converted values into batches
+    for rows, converted_rows in chunks:
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size], converted_rows[start:start + batch_size]
+
+
+def run_data_bulk(table_info, headers, chunks, cursor, should_execute, metrics):
+    # Get schema information, identity indicator and primary key columns
+    schema_name, table = table_info.schema_name, table_info.table_name
+    has_identity, pk_columns = table_info.has_identity, table_info.pk_columns
+    if not pk_columns:
+        raise ValueError(f'No primary key for {table} was found.')
+
+    # Get the staging, staging insert and merge statements
+    stage_table = '#Stage' + table
+    stage = get_stage_statement(headers, schema_name, table, stage_table)
+    stage_insert = get_stage_insert_statement(headers, stage_table)
+    merge = get_merge_statement(headers, schema_name, table, stage_table, pk_columns)
+    print(stage)
+    print(merge)
+
+    # If only testing, show what would be staged
+    if not should_execute:
+        row_count = sum(len(rows) for rows in get_batches(chunks, stage_batch_size))
+        print(f'{row_count} rows would be staged for {schema_name}.{table}')
+        return []
+
+    # Create the staging table and load the rows into it with parameterized batches
+    execute_cursor(cursor, stage, should_execute)
+    try:
+        # Fast executemany sends the rows in parameter arrays (pyodbc 4.0.19 and later)
+        if hasattr(cursor, 'fast_executemany'):
+            cursor.fast_executemany = True
+        row_count = 0
+        for rows, parameter_rows in get_converted_batches(chunks, stage_batch_size):
+            cursor.executemany(stage_insert, [parameter_row + [row_count + index]
+                                              for index, parameter_row in enumerate(parameter_rows)])
+            row_count += len(rows)
+
+        # Apply the staged rows and count the actions taken
+        try:
+            with identity_insert(cursor, schema_name, table, has_identity, should_execute):
+                actions = [row[0] for row in execute_cursor(cursor, merge, should_execute).fetchall()]
+        except pyodbc.IntegrityError as e:
+            # If it fails, supporting (foreign key) rows may not have been loaded yet
+            print('Statement Fail:')
+            print(e)
+            return [(merge, ())]
+    finally:
+        # Drop the staging table
+        execute_cursor(cursor, 'DROP TABLE ' + stage_table, should_execute)
+
+    # Show inserted, updated and unchanged counts
+    inserted = actions.count('INSERT')
+    updated = actions.count('UPDATE')
+    unchanged = row_count - inserted - updated
+    print(f'{schema_name}.{table}: {inserted} inserted, {updated} updated, {unchanged} unchanged')
+    metrics.count('inserted', inserted)
+    metrics.count('updated', updated)
+    return []
+
+
+def get_stage_statement(headers, schema_name, table, stage_table):
+    # Build an empty staging table with the column types of the target table, and a column for the row number.
+    # The UNION ALL stops SELECT INTO from copying the identity property.
+    columns = ', '.join(headers)
+    source = ' FROM ' + schema_name + '.' + table
+    return 'SELECT TOP 0 ' + columns + ', CAST(0 AS BIGINT) AS ' + stage_row_column + ' INTO ' + stage_table + \
+           source + ' UNION ALL SELECT TOP 0 ' + columns + ', 0' + source
+
+
+def get_stage_insert_statement(headers, stage_table):
+    # Build parameterized insert statement for the staging table, with the row number last
+    return 'INSERT INTO ' + stage_table + ' (' + ', '.join(headers + [stage_row_column]) + ') VALUES (' + \
+           ', '.join('?' for _ in headers + [stage_row_column]) + ')'
+
+
+def get_merge_statement(headers, schema_name, table, stage_table, pk_columns):
+    # Build merge statement matching staged rows to table rows on the primary key. A key repeated in the file
+    # is merged once with its last row, as loading row by row inserts the first row and updates it with the rest.
+    staged = 'SELECT ' + ', '.join(headers) + ', ROW_NUMBER() OVER (PARTITION BY ' + ', '.join(pk_columns) + \
+             ' ORDER BY ' + stage_row_column + ' DESC) AS KeyRow FROM ' + stage_table
+    statement = 'MERGE ' + schema_name + '.' + table + ' AS target USING (SELECT ' + ', '.join(headers) + \
+                ' FROM (' + staged + ') AS staged WHERE KeyRow = 1) AS source ON ' + \
+                ' AND '.join('target.' + pk + ' = source.' + pk for pk in pk_columns)
+    # Update rows where anything beyond the primary key has changed (EXCEPT treats nulls as equal)
+    update_columns = [item for item in headers if item not in pk_columns]
+    if update_columns:
+        statement += ' WHEN MATCHED AND EXISTS (SELECT ' + \
+                     ', '.join('source.' + item for item in update_columns) + ' EXCEPT SELECT ' + \
+                     ', '.join('target.' + item for item in update_columns) + ') THEN UPDATE SET ' + \
+                     ', '.join(item + ' = source.' + item for item in update_columns)
+    # Insert rows that do not exist
+    statement += ' WHEN NOT MATCHED BY TARGET THEN INSERT (' + ', '.join(headers) + ') VALUES (' + \
+                 ', '.join('source.' + item for item in headers) + ')'
+    # Return the action taken for each row
+    statement += ' OUTPUT $action;'
+    return statement
+
+
+def execute_cursor(cursor, statement, should_execute, parameters=()):
     if should_execute:
+        if parameters:
+            return cursor.execute(statement, parameters)
         return cursor.execute(statement)
 
     return None
 
 
-def get_select_statement(schema_name, table, pk_columns, header_data_dict):
-    # Build select statement to determine if row exists
-    select = 'SELECT 1 FROM ' + schema_name + '.' + table + get_where_clause(pk_columns, header_data_dict)
-    return select
+def execute_batch(cursor, schema_name, table, statement, parameter_rows, should_execute):
+    # Run a parameterized statement for a batch of rows and return the rows that failed
+    if not parameter_rows or not should_execute:
+        return []
 
+    # Save the transaction so the rows of a failed batch that did run can be undone.
+    # After a commit there is no transaction until the next statement, so read the table to have the connection
+    # start one. Beginning one here would nest it in the connection's transaction and commit would not end it.
+    cursor.execute('SELECT TOP (0) 1 FROM ' + schema_name + '.' + table)
+    cursor.execute('SAVE TRANSACTION LoadCsvFilesBatch')
+    try:
+        # Fast executemany sends the rows in parameter arrays (pyodbc 4.0.19 and later)
+        if hasattr(cursor, 'fast_executemany'):
+            cursor.fast_executemany = True
+        cursor.executemany(statement, parameter_rows)
+        return []
+    except pyodbc.IntegrityError:
+        cursor.execute('ROLLBACK TRANSACTION LoadCsvFilesBatch')
 
-def get_insert_statement(headers, row, schema_name, table):
-    # Build insert statement
-    statement = 'INSERT INTO ' + schema_name + '.' + table + ' (' + ', '.join(headers) + ') VALUES ('
-    first = True
-    for item in row:
-        statement += ('' if first else ', ') + get_value(item)
-        first = False
-    statement += ')'
+    # Run the batch row by row to find the failing rows
+    try_later = []
+    for parameters in parameter_rows:
+        try:
+            cursor.execute(statement, parameters)
+        except pyodbc.IntegrityError:
+            # If it fails, supporting (foreign key) rows may not have been loaded yet,
+            # save it to try again later
+            try_later.append((statement, parameters))
+    return try_later
+
+
+def get_statement_text(statement, parameters):
+    # Show a statement with its parameters, if it has any
+    if parameters:
+        return statement + ' -- ' + ', '.join(repr(item) for item in parameters)
     return statement
 
 
-def get_update_statement(headers, header_data_dict, schema_name, table, pk_columns):
+def get_existing_keys(cursor, schema_name, table, pk_columns, key_limit, key_converters):
+    # Count the rows so we know if the keys will fit in memory
+    count = cursor.execute('SELECT COUNT_BIG(*) FROM ' + schema_name + '.' + table).fetchone()[0]
+    if count > key_limit:
+        print(f'{schema_name}.{table} has {count} rows, looking up keys in batches of {lookup_batch_size}')
+        return None
+
+    # Stream the primary keys into a set
+    cursor.execute('SELECT ' + ', '.join(pk_columns) + ' FROM ' + schema_name + '.' + table)
+    return fetch_keys(cursor, key_converters)
+
+
+def fetch_keys(cursor, key_converters):
+    # Read the results of a key query into a set a batch at a time
+    keys = set()
+    while True:
+        results = cursor.fetchmany(fetch_batch_size)
+        if not results:
+            break
+        keys.update(get_key(result, key_converters) for result in results)
+    return keys
+
+
+def get_existing_keys_for_rows(cursor, schema_name, table, pk_columns, header_literal_dicts, key_converters):
+    # Look up which of the rows already exist with one query
+    lookup = get_lookup_statement(schema_name, table, pk_columns, header_literal_dicts)
+    return {get_key(result, key_converters) for result in cursor.execute(lookup).fetchall()}
+
+
+def get_existing_keys_for_parameters(cursor, schema_name, table, pk_columns, key_rows, key_converters):
+    # Look up which of the keys already exist with one parameterized query
+    lookup = get_parameterized_lookup_statement(schema_name, table, pk_columns, len(key_rows))
+    parameters = [item for key_row in key_rows for item in key_row]
+    return {get_key(result, key_converters) for result in cursor.execute(lookup, parameters).fetchall()}
+
+
+def get_parameterized_lookup_statement(schema_name, table, pk_columns, row_count):
+    # Build parameterized select statement returning the primary keys of the rows that exist
+    select = 'SELECT ' + ', '.join(pk_columns) + ' FROM ' + schema_name + '.' + table + ' WHERE '
+    if len(pk_columns) == 1:
+        return select + pk_columns[0] + ' IN (' + ', '.join('?' for _ in range(row_count)) + ')'
+    predicate = '(' + ' AND '.join(pk + ' = ?' for pk in pk_columns) + ')'
+    return select + ' OR '.join(predicate for _ in range(row_count))
+
+
+def get_lookup_statement(schema_name, table, pk_columns, header_literal_dicts):
+    # Build select statement returning the primary keys of the rows that exist
+    select = 'SELECT ' + ', '.join(pk_columns) + ' FROM ' + schema_name + '.' + table + ' WHERE '
+    # A single column key can use IN, a composite key needs a predicate per row
+    if len(pk_columns) == 1:
+        pk = pk_columns[0]
+        return select + pk + ' IN (' + ', '.join(item[pk] for item in header_literal_dicts) + ')'
+    return select + ' OR '.join(
+        '(' + get_where_clause(pk_columns, item)[len(' WHERE '):] + ')' for item in header_literal_dicts)
+
+
+def get_key(values, key_converters):
+    # Build a hashable key from CSV text or database values, each converted for the type of its column
+    return tuple(convert(value) for convert, value in zip(key_converters, values))
+
+
+def get_key_converters(table_info, columns):
+    # Get a key converter for each column from its SQL type
+    column_types = get_column_types(table_info)
+    return [get_key_converter(column_types.get(item.lower())) for item in columns]
+
+
+def get_key_converter(type_name):
+    # Numbers compare as numbers of their column's type, so 7 and 07 are the same integer but not the same text
+    if type_name in integer_types:
+        return lambda item: get_key_number(item, int, integer_pattern)
+    if type_name in decimal_types:
+        return lambda item: get_key_number(item, decimal.Decimal, decimal_pattern)
+    if type_name in float_types:
+        return lambda item: get_key_number(item, float, decimal_pattern)
+    if type_name in bit_types:
+        return get_key_bit
+    # Character types and anything else compare as text
+    return get_key_text
+
+
+def get_key_bit(item):
+    # Bit columns come back from the database as booleans
+    if isinstance(item, bool):
+        return item
+    if item is None or item == '':
+        return None
+    return bit_values.get(str(item).strip().lower(), get_key_text(item))
+
+
+def get_key_number(item, convert, pattern):
+    # Empty is null, text that is not a number of the type is compared as text for the server to reject
+    if item is None or item == '':
+        return None
+    if isinstance(item, str):
+        if not pattern.match(item):
+            return get_key_text(item)
+        item = item.strip()
+    value = convert(item)
+    # NaN is never equal to itself, so it is compared as text
+    return value if value == value else 'nan'
+
+
+def get_key_text(item):
+    # Empty is null
+    if item is None or item == '':
+        return None
+    # Dates come back from the database as datetimes, show them the way they are usually written in a CSV
+    if isinstance(item, datetime.datetime):
+        item = item.date() if item.time() == datetime.time() else item.isoformat(' ')
+    if isinstance(item, datetime.date):
+        item = item.isoformat()
+    # SQL Server's default collations ignore case and trailing spaces
+    return str(item).rstrip().casefold()
+
+
+def get_insert_statement(headers, literal_row, schema_name, table):
+    # Build insert statement from SQL literals
+    return 'INSERT INTO ' + schema_name + '.' + table + ' (' + ', '.join(headers) + ') VALUES (' + \
+           ', '.join(literal_row) + ')'
+
+
+def get_update_statement(headers, header_literal_dict, schema_name, table, pk_columns):
     # Build update statement
     statement = 'UPDATE ' + schema_name + '.' + table + ' SET '
     first = True
@@ -203,24 +1420,98 @@ def get_update_statement(headers, header_data_dict, schema_name, table, pk_colum
     for item in headers:
         if item in pk_columns:
             continue
-        statement += ('' if first else ', ') + item + ' = ' + get_value(header_data_dict[item])
+        statement += ('' if first else ', ') + item + ' = ' + header_literal_dict[item]
         first = False
         something_to_update = True
-    statement += get_where_clause(pk_columns, header_data_dict)
+    statement += get_where_clause(pk_columns, header_literal_dict)
     return something_to_update, statement
 
 
-def get_where_clause(pk_columns, header_data_dict):
-    # Build where clause
+def get_parameterized_insert_statement(headers, schema_name, table):
+    # Build parameterized insert statement
+    return 'INSERT INTO ' + schema_name + '.' + table + ' (' + ', '.join(headers) + ') VALUES (' + \
+           ', '.join('?' for _ in headers) + ')'
+
+
+def get_parameterized_update_statement(update_columns, schema_name, table, pk_columns):
+    # Build parameterized update statement, with the primary key parameters last
+    return 'UPDATE ' + schema_name + '.' + table + ' SET ' + ', '.join(item + ' = ?' for item in update_columns) + \
+           ' WHERE ' + ' AND '.join(pk + ' = ?' for pk in pk_columns)
+
+
+def get_where_clause(pk_columns, header_literal_dict):
+    # Build where clause from SQL literals
     where = ' WHERE '
     first = True
     for pk in pk_columns:
-        where += ('' if first else ' AND ') + pk + ' = ' + get_value(header_data_dict[pk])
+        where += ('' if first else ' AND ') + pk + ' = ' + header_literal_dict[pk]
         first = False
 
     return where
 
 
+def get_column_converters(table_info, headers, literal):
+    # Get a converter for each column from its SQL type, to SQL literals or to parameter values
+    column_types = get_column_types(table_info)
+    get_converter = get_literal_converter if literal else get_parameter_converter
+    return [get_converter(column_types.get(item.lower())) for item in headers]
+
+
+def get_column_types(table_info):
+    # Get the lower case SQL type by lower case column name, using the base type of an alias type
+    return {column.name.lower(): (column.base_type_name or column.type_name).lower() for column in table_info.columns}
+
+
+def get_literal_converter(type_name):
+    # Empty strings are null. Numbers are only left unquoted if they match the pattern for the type.
+    if type_name in integer_types or type_name in decimal_types or type_name in float_types:
+        pattern = integer_pattern if type_name in integer_types else decimal_pattern
+        return lambda item: item if is_plain_number(item) else 'null' if item == '' \
+            else item.strip() if pattern.match(item) else get_quoted(item)
+    if type_name in bit_types:
+        return lambda item: 'null' if item == '' else bit_literals.get(item.strip().lower()) or get_quoted(item)
+    if type_name in unicode_types:
+        return lambda item: 'null' if item == '' else 'N' + get_quoted(item)
+    if type_name in text_types:
+        return lambda item: 'null' if item == '' else get_quoted(item)
+    # Columns of other types are converted by the value
+    return get_value
+
+
+def get_parameter_converter(type_name):
+    # Empty strings are null. Numbers are only converted if they match the pattern for the type,
+    # anything else is left as text for the server to convert or reject.
+    if type_name in integer_types:
+        return lambda item: int(item) if item.isascii() and item.isdigit() else None if item == '' \
+            else int(item) if integer_pattern.match(item) else item
+    if type_name in decimal_types:
+        return lambda item: decimal.Decimal(item) if is_plain_number(item) else None if item == '' \
+            else decimal.Decimal(item.strip()) if decimal_pattern.match(item) else item
+    if type_name in float_types:
+        return lambda item: float(item) if is_plain_number(item) else None if item == '' \
+            else float(item) if decimal_pattern.match(item) else item
+    if type_name in bit_types:
+        return lambda item: None if item == '' else bit_values.get(item.strip().lower(), item)
+    return lambda item: None if item == '' else item
+
+
+def convert_rows(rows, converters):
+    # Convert a chunk column by column, short rows are filled with nulls
+    columns = itertools.zip_longest(*rows, fillvalue='')
+    converted = [list(map(converter, column)) for converter, column in zip(converters, columns)]
+    return [list(row) for row in zip(*converted)]
+
+
+def is_plain_number(item):
+    # Digits with at most one decimal point, checked without a regular expression
+    return item.isascii() and item.replace('.', '', 1).isdigit()
+
+
+def get_quoted(item):
+    # Return value in single quotes
+    return '\'' + item.replace('\'', '\'\'') + '\''
+
+
 def get_value(item):
     # Return null or value with quotes where appropriate
     if item == '':
@@ -247,7 +1538,11 @@ def main(argv):
     # Get command line options
     try:
         opts, args = getopt.getopt(
-            argv, 'hp:s:d:u:w:t', ['help', 'path=', 'server=', 'database=', 'user=', 'password=', 'test'])
+            argv, 'hp:s:d:u:w:tl:g:bqk:c:n:x:m:ri:eo:j:vf:a:y:z',
+            ['help', 'path=', 'server=', 'database=', 'user=', 'password=', 'test', 'plan=', 'plan-script=', 'bulk',
+             'parameterized', 'key-limit=', 'chunk-size=', 'workers=', 'transaction=', 'schema-cache=',
+             'refresh-schema', 'manifest=', 'delete-missing', 'commit-every=', 'checkpoint=',
+             'validate', 'orphan-report=', 'parse-workers=', 'metrics=', 'progress'])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -258,13 +1553,18 @@ def main(argv):
         sys.exit(2)
 
     # Get arguments
-    database, password, path, server, user, test = get_args(opts)
+    database, password, path, server, user, test, plan_file, plan_script, bulk, parameterized, key_limit, chunk_size, \
+        workers, transaction, schema_cache, refresh_schema, manifest_file, delete_missing, commit_every, \
+        checkpoint_file, validate, orphan_report, parse_workers, metrics_file, progress = get_args(opts)
     should_execute = not test
     if test:
-        print('Performing test run only. Statements will not be executed against the database.')
+        print('Performing test run only. The load is planned and statements will not be executed against the database.')
 
-    # If arguments are missing, show usage and exit
-    if path is None or server is None or database is None or user is None or password is None:
+    # If arguments are missing or invalid, show usage and exit
+    if path is None or server is None or database is None or user is None or password is None \
+            or workers < 1 or parse_workers < 0 or transaction not in ('table', 'all') \
+            or (delete_missing and manifest_file is None) \
+            or ((commit_every is not None or checkpoint_file is not None) and transaction != 'table'):
         usage()
         sys.exit(4)
 
@@ -272,59 +1572,142 @@ def main(argv):
     print('Finding files in ' + path)
     files = get_files_from_path(path)
 
-    # For each file, if it is a csv file, get rows
-    data_dictionary = {}
+    # For each file, if it is a csv file, get the encoding and headers.
+    # The rows are read a chunk at a time when the table is loaded.
+    file_dictionary = {}
     for file in [file for file in files if file.endswith('.csv')]:
         print(file)
-        # Try getting rows from the file as utf
-        try:
-            headers, data = get_rows_from_file(file, 'utf-8-sig')
-        except UnicodeDecodeError:
-            # Try getting rows from the file as cp1252 (common on windows)
-            headers, data = get_rows_from_file(file, 'cp1252')
-        print(headers)
-        print(data)
+        file_encoding = FileReader.get_file_encoding(file)
+        print(get_headers_from_file(file, file_encoding))
 
         # Get table name
         table_name = get_table_name(file)
 
-        # Load headers and rows into dictionary
-        data_dictionary[table_name] = headers, data
+        # Load file and encoding into dictionary
+        file_dictionary[table_name] = file, file_encoding
 
     # Build the connection string
     connection_string = 'DRIVER={SQL Server};SERVER=' + server + ';DATABASE=' + database + ';UID=' + \
                         user + ';PWD=' + password
     print(connection_string)
 
-    # Connect to the database
-    connection = pyodbc.connect(connection_string, autocommit=False)
-    cursor = connection.cursor()
+    # Connect to the database with a connection for each worker
+    pool = get_connection_pool(lambda: pyodbc.connect(connection_string, autocommit=False), workers)
+
+    # Get the schema metadata for every table with one query, or from the cache
+    connection = pool.get()
+    metadata = SchemaMetadata.get_schema_metadata(
+        connection.cursor(), server, database, schema_cache, refresh_schema)
+    pool.put(connection)
+
+    # Order the tables by their foreign keys so parents are loaded before children
+    dependencies = get_dependencies(metadata, list(file_dictionary))
+    levels, remaining = get_load_levels(list(file_dictionary), dependencies)
+    # If there is a cycle then show it and load the remaining tables last
+    if remaining:
+        print('Foreign key cycle found between: ' + ', '.join(get_cycle_tables(remaining, dependencies)))
+        print('These tables are loaded last and may have failed statements: ' + ', '.join(remaining))
+        levels.append(remaining)
+
+    # If validating then find the rows whose foreign keys have no parent before anything is sent
+    checks = {}
+    if validate:
+        connection = pool.get()
+        checks, orphans = validate_foreign_keys(
+            [table for level in levels for table in level], file_dictionary, metadata, connection.cursor(), chunk_size)
+        pool.put(connection)
+        if orphans:
+            print('Rows without a parent were found and will not be loaded.')
+            show_orphans(orphans)
+        if orphan_report is not None:
+            with open(orphan_report, 'w', encoding='utf-8') as fp:
+                json.dump({'server': server, 'database': database, 'constraints': orphans}, fp, indent=2)
+
+    # Load a table from its file on the given cursor, recording its metrics
+    metrics = {}
+
+    def load(table, cursor):
+        file, file_encoding = file_dictionary[table]
+        table_metrics = metrics[table] = TableMetrics(table, progress)
+        try:
+            return load_table(get_table_info(table, metadata), file, file_encoding, cursor, should_execute, bulk,
+                              parameterized, key_limit, chunk_size, manifest, plan, write_script, checkpoint,
+                              commit_every, checks.get(table), executor, table_metrics)
+        finally:
+            table_metrics.finish()
+
+    # Delete the rows of a table that are no longer in its file
+    def delete(table, cursor):
+        return delete_missing_rows(get_table_info(table, metadata), cursor, should_execute, manifest)
 
-    # Run statements for Metric and Metric Variant first
-    table_name = 'Metric'
-    headers, data = data_dictionary[table_name]
-    failed_statements = run_data(table_name, headers, data, cursor, should_execute)
-    del data_dictionary[table_name]
+    # If testing then plan the load, writing the statements that would run to the script if there is one
+    plan = {}
+    write_script = None
+    if test and plan_script is not None:
+        script_fp = open(plan_script, 'w', encoding='utf-8')
+        script_lock = threading.Lock()
 
-    table_name = 'MetricVariant'
-    headers, data = data_dictionary[table_name]
-    failed_statements += run_data(table_name, headers, data, cursor, should_execute)
-    del data_dictionary[table_name]
+        def write_script(text):
+            with script_lock:
+                script_fp.write(text)
+
+    # Run the data in dependency order
+    manifest = LoadManifest(manifest_file, server, database) if manifest_file is not None else None
+    checkpoint = LoadCheckpoint(checkpoint_file, server, database, chunk_size) if checkpoint_file is not None else None
+    executor = ProcessPoolExecutor(parse_workers) if parse_workers else None
+    try:
+        failed_statements, errors = load_levels(
+            levels, dependencies, pool, load, workers, transaction, delete if delete_missing else None)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Commit the changes, or roll them back if loading all or nothing and a table failed, and close the connections
+    committed = not errors or transaction == 'table'
+    close_connection_pool(pool, committed)
+
+    # Record the files and rows that were loaded
+    if manifest is not None:
+        if committed and should_execute:
+            manifest.save()
+        manifest.close()
+
+    # If everything was loaded then the next run starts from the beginning
+    if checkpoint is not None and should_execute and not errors and not failed_statements:
+        checkpoint.remove()
+
+    # If testing then show the plan and write it to the plan file
+    if test:
+        if write_script is not None:
+            script_fp.close()
+        for count in ('inserts', 'updates', 'unchanged'):
+            print(f'Total {count}: {sum(counts[count] for counts in plan.values())}')
+        if plan_file is not None:
+            with open(plan_file, 'w', encoding='utf-8') as fp:
+                json.dump({'server': server, 'database': database, 'tables': plan}, fp, indent=2)
 
-    # Run the rest of the data
-    for key in data_dictionary:
-        headers, data = data_dictionary[key]
-        failed_statements += run_data(key, headers, data, cursor, should_execute)
+    # Show the metrics for each table and write them to the metrics file
+    summaries = {table: table_metrics.summary() for table, table_metrics in metrics.items()}
+    for table, summary in summaries.items():
+        print(f"{table}: {summary['rows_read']} rows read, {summary['inserted']} inserted, {summary['updated']} "
+              f"updated, {summary['skipped']} skipped, {summary['statements']} statements, "
+              f"{summary['round_trips']} round trips, {summary['rows_per_second']} rows/sec")
+    if metrics_file is not None:
+        with open(metrics_file, 'w', encoding='utf-8') as fp:
+            json.dump({'server': server, 'database': database, 'tables': summaries}, fp, indent=2)
 
-    # Commit the changes and close the connection
-    connection.commit()
-    connection.close()
+    # If any tables failed then show them
+    if errors:
+        print('At least one table failed to load.' +
+              (' All changes were rolled back.' if transaction == 'all' else ''))
+        for table, error in errors.items():
+            print(table + ': ' + str(error))
 
     # If there are still any failed statements then show them
     if failed_statements:
         print('At lease one statement failed.')
-        for statement in failed_statements:
-            print(statement)
+        for statement, parameters in failed_statements:
+            print(get_statement_text(statement, parameters))
 
 
 if __name__ == '__main__':
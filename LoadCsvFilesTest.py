@@ -0,0 +1,470 @@
+import decimal
+import FileReader
+import LoadCsvFiles
+import os
+import pyodbc
+import SchemaMetadata
+import sqlite3
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FakeConnection:
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+
+    def cursor(self):
+        return self
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class RecordingCursor:
+    def __init__(self, results=()):
+        self.statements = []
+        self.results = list(results)
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        return self
+
+    def executemany(self, statement, parameter_rows):
+        self.statements.append(statement)
+
+    def fetchmany(self, size):
+        results, self.results = self.results[:size], self.results[size:]
+        return results
+
+
+class TableCursor(RecordingCursor):
+    # Answers the key queries with the rows of a table and a MERGE with its actions, and fails the inserts
+    # of the given keys, as a missing foreign key parent would
+    def __init__(self, rows, failing=(), actions=()):
+        super().__init__()
+        self.rows = rows
+        self.failing = failing
+        self.actions = actions
+        self.parameter_rows = []
+        self.connection = FakeConnection()
+
+    def execute(self, statement, *parameters):
+        if statement.startswith('INSERT') and any('(' + key + ')' in statement for key in self.failing):
+            raise pyodbc.IntegrityError('23000', 'The INSERT statement conflicted with the FOREIGN KEY constraint.')
+        if statement.startswith('SELECT COUNT_BIG'):
+            self.results = [(len(self.rows),)]
+        elif statement.startswith('SELECT'):
+            self.results = list(self.rows)
+        elif statement.startswith('MERGE'):
+            self.results = [(action,) for action in self.actions]
+        return super().execute(statement)
+
+    def executemany(self, statement, parameter_rows):
+        self.parameter_rows += parameter_rows
+        super().executemany(statement, parameter_rows)
+
+    def fetchone(self):
+        return self.results[0]
+
+    def fetchall(self):
+        results, self.results = self.results, []
+        return results
+
+
+class TestLoadCsvFiles(unittest.TestCase):
+    def test_get_load_levels(self):
+        dependencies = {'MetricVariant': {'Metric'}, 'Metric': set(), 'MetricAction': {'Metric', 'MetricVariant'}}
+        levels, remaining = LoadCsvFiles.get_load_levels(list(dependencies), dependencies)
+        self.assertEqual([['Metric'], ['MetricVariant'], ['MetricAction']], levels)
+        self.assertEqual([], remaining)
+
+    def test_get_load_levels_cycle(self):
+        dependencies = {'A': {'B'}, 'B': {'A'}, 'C': {'A'}, 'D': set()}
+        levels, remaining = LoadCsvFiles.get_load_levels(list(dependencies), dependencies)
+        self.assertEqual([['D']], levels)
+        self.assertEqual(['A', 'B', 'C'], remaining)
+        self.assertEqual(['A', 'B'], LoadCsvFiles.get_cycle_tables(remaining, dependencies))
+
+    def test_get_table_groups(self):
+        dependencies = {'A': set(), 'B': set(), 'C': {'A'}, 'D': {'C'}}
+        levels, _ = LoadCsvFiles.get_load_levels(list(dependencies), dependencies)
+        self.assertEqual([['A', 'C', 'D'], ['B']], LoadCsvFiles.get_table_groups(levels, dependencies))
+
+    def test_load_levels_per_table(self):
+        connections = [FakeConnection(), FakeConnection()]
+        pool = LoadCsvFiles.get_connection_pool(iter(connections).__next__, 2)
+        loaded = []
+
+        def load(table, cursor):
+            if table == 'B':
+                raise ValueError('No table for B was found.')
+            loaded.append(table)
+            return []
+
+        dependencies = {'A': set(), 'B': set(), 'C': {'A'}}
+        failed, errors = LoadCsvFiles.load_levels([['A', 'B'], ['C']], dependencies, pool, load, 2, 'table')
+        self.assertEqual([], failed)
+        self.assertEqual(['B'], list(errors))
+        self.assertEqual(['A', 'C'], sorted(loaded))
+        self.assertEqual(2, sum(connection.commits for connection in connections))
+        self.assertEqual(1, sum(connection.rollbacks for connection in connections))
+
+    def test_load_levels_all_or_nothing(self):
+        connections = [FakeConnection(), FakeConnection()]
+        pool = LoadCsvFiles.get_connection_pool(iter(connections).__next__, 2)
+
+        def load(table, cursor):
+            if table == 'C':
+                raise ValueError('No table for C was found.')
+            return ['INSERT ' + table] if table == 'B' else []
+
+        dependencies = {'A': set(), 'B': set(), 'C': {'A'}}
+        failed, errors = LoadCsvFiles.load_levels([['A', 'B'], ['C']], dependencies, pool, load, 2, 'all')
+        self.assertEqual(['INSERT B'], failed)
+        self.assertEqual(['A, C'], list(errors))
+        self.assertEqual(0, sum(connection.commits for connection in connections))
+        LoadCsvFiles.close_connection_pool(pool, not errors)
+        self.assertEqual([1, 1], [connection.rollbacks for connection in connections])
+        self.assertTrue(all(connection.closed for connection in connections))
+
+    def test_identity_insert_turned_off_after_error(self):
+        cursor = RecordingCursor()
+        with self.assertRaises(ValueError):
+            with LoadCsvFiles.identity_insert(cursor, 'metric', 'MetadataList', True, True):
+                cursor.execute('INSERT INTO metric.MetadataList (MetadataListId) VALUES (1)')
+                raise ValueError('Connection lost')
+        self.assertEqual(['SET IDENTITY_INSERT metric.MetadataList ON',
+                          'INSERT INTO metric.MetadataList (MetadataListId) VALUES (1)',
+                          'SET IDENTITY_INSERT metric.MetadataList OFF'], cursor.statements)
+
+    def test_manifest_filters_unchanged_rows(self):
+        file = os.path.join(tempfile.mkdtemp(), 'manifest.db')
+        manifest = LoadCsvFiles.LoadManifest(file, '.', 'EdFi_Dashboard')
+        chunks = [[['1', 'Reading'], ['2', 'Math']]]
+        self.assertEqual(chunks,
+                         list(manifest.filter_chunks('Metric', ['MetricId', 'Name'], ['MetricId'], 'a', chunks)))
+        manifest.mark_loaded('Metric')
+        manifest.save()
+        manifest.close()
+
+        manifest = LoadCsvFiles.LoadManifest(file, '.', 'EdFi_Dashboard')
+        self.assertTrue(manifest.is_unchanged('Metric', 'a'))
+        chunks = [[['1', 'Reading'], ['3', 'Science']]]
+        self.assertEqual([[['3', 'Science']]],
+                         list(manifest.filter_chunks('Metric', ['MetricId', 'Name'], ['MetricId'], 'b', chunks)))
+        self.assertEqual([['2']], manifest.get_missing_keys('Metric'))
+        manifest.close()
+
+    def test_checkpoint_resumes_after_committed_chunks(self):
+        directory = tempfile.mkdtemp()
+        file = os.path.join(directory, 'Metric.csv')
+        with open(file, 'w') as fp:
+            fp.write('MetricId\n1\n2\n3\n')
+        checkpoint_file = os.path.join(directory, 'checkpoint.json')
+        checkpoint = LoadCsvFiles.LoadCheckpoint(checkpoint_file, '.', 'EdFi_Dashboard', 1)
+        cursor = RecordingCursor()
+        cursor.connection = FakeConnection()
+        converted = [([['1']], [[1]]), ([['2']], [[2]]), ([['3']], [[3]])]
+        chunks = LoadCsvFiles.commit_chunks(iter(converted), 'Metric', file, cursor, checkpoint, 2, 0)
+        self.assertEqual(converted[:2], [next(chunks), next(chunks)])
+        next(chunks)
+        self.assertEqual(1, cursor.connection.commits)
+
+        checkpoint = LoadCsvFiles.LoadCheckpoint(checkpoint_file, '.', 'EdFi_Dashboard', 1)
+        self.assertEqual(2, checkpoint.get_start('Metric', file))
+        chunks = LoadCsvFiles.commit_chunks(iter(converted[2:]), 'Metric', file, cursor, checkpoint, 1, 2)
+        self.assertEqual(converted[2:], list(chunks))
+        self.assertEqual(3, LoadCsvFiles.LoadCheckpoint(checkpoint_file, '.', 'EdFi_Dashboard', 1).get_start(
+            'Metric', file))
+        checkpoint.save('Metric', file, 0, True)
+        self.assertIsNone(checkpoint.get_start('Metric', file))
+        checkpoint = LoadCsvFiles.LoadCheckpoint(checkpoint_file, '.', 'EdFi_Dashboard', 2)
+        self.assertEqual(0, checkpoint.get_start('Metric', file))
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(checkpoint_file))
+
+    def test_checkpoint_reloads_table_with_failed_rows(self):
+        directory = tempfile.mkdtemp()
+        file = os.path.join(directory, 'Metric.csv')
+        with open(file, 'w') as fp:
+            fp.write('MetricId\n1\n2\n')
+        table_info = SchemaMetadata.TableInfo('dbo', 'Metric', [
+            SchemaMetadata.Column('MetricId', 'int', 4, 10, 0, False, False)], ['MetricId'], False, [])
+        checkpoint_file = os.path.join(directory, 'checkpoint.json')
+
+        def load(cursor):
+            checkpoint = LoadCsvFiles.LoadCheckpoint(checkpoint_file, '.', 'EdFi_Dashboard', 1)
+            return LoadCsvFiles.load_table(table_info, file, 'utf-8-sig', cursor, True, False, False, 10, 1, None,
+                                           None, None, checkpoint, 1, None, None,
+                                           LoadCsvFiles.TableMetrics('Metric', False))
+
+        self.assertEqual(1, len(load(TableCursor([], ['2']))))
+        cursor = TableCursor([(1,)])
+        self.assertEqual([], load(cursor))
+        self.assertEqual(['INSERT INTO dbo.Metric (MetricId) VALUES (2)'],
+                         [statement for statement in cursor.statements if statement.startswith('INSERT')])
+        self.assertIsNone(LoadCsvFiles.LoadCheckpoint(checkpoint_file, '.', 'EdFi_Dashboard', 1).get_start(
+            'Metric', file))
+
+    def test_convert_chunks_ahead(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'Metric', [
+            SchemaMetadata.Column('MetricId', 'int', 4, 10, 0, False, False),
+            SchemaMetadata.Column('Name', 'nvarchar', 100, 0, 0, True, False)], ['MetricId'], False, [])
+        chunks = [[['1', 'Reading'], []], [['2', "Writer's"]], [], [['3', '']]] * 3
+        metrics = LoadCsvFiles.TableMetrics('Metric', False)
+        expected = list(LoadCsvFiles.convert_chunks(iter(chunks), table_info, ['MetricId', 'Name'], True, None,
+                                                    metrics))
+        self.assertEqual(([['1', 'Reading']], [['1', "N'Reading'"]]), expected[0])
+        with ThreadPoolExecutor(2) as executor:
+            converted = LoadCsvFiles.convert_chunks(LoadCsvFiles.read_ahead(iter(chunks), 2), table_info,
+                                                    ['MetricId', 'Name'], True, executor, metrics)
+            self.assertEqual(expected, list(converted))
+
+    def test_metered_cursor_counts_round_trips(self):
+        metrics = LoadCsvFiles.TableMetrics('Metric', False)
+        cursor = LoadCsvFiles.MeteredCursor(RecordingCursor([(1,), (2,), (3,)]), metrics)
+        cursor.execute('SELECT MetricId FROM dbo.Metric')
+        key_converters = [LoadCsvFiles.get_key_converter('int')]
+        self.assertEqual({(1,), (2,), (3,)}, LoadCsvFiles.fetch_keys(cursor, key_converters))
+        for chunk in LoadCsvFiles.time_chunks([[['1'], []], [['2']]], metrics):
+            metrics.count('inserted', len([row for row in chunk if row]) - 1)
+        summary = metrics.summary()
+        self.assertEqual((1, 3, 2, 0, 2), (summary['statements'], summary['round_trips'], summary['rows_read'],
+                                           summary['inserted'], summary['skipped']))
+
+    def test_get_key_by_column_type(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'Metric', [
+            SchemaMetadata.Column('MetricId', 'bigint', 8, 19, 0, False, False),
+            SchemaMetadata.Column('Code', 'varchar', 10, 0, 0, True, False),
+            SchemaMetadata.Column('Weight', 'float', 8, 53, 0, True, False),
+            SchemaMetadata.Column('Amount', 'decimal', 9, 18, 2, True, False)], ['MetricId'], False, [])
+        converters = LoadCsvFiles.get_key_converters(table_info, ['MetricId', 'Code', 'Weight', 'Amount'])
+        self.assertEqual(LoadCsvFiles.get_key(['007', '7', '1.5', '2.50'], converters),
+                         LoadCsvFiles.get_key([7, '7', 1.5, 2.5], converters))
+        self.assertNotEqual(LoadCsvFiles.get_key(['1', '007'], converters),
+                            LoadCsvFiles.get_key(['1', '7'], converters))
+        self.assertNotEqual(LoadCsvFiles.get_key([str(2 ** 53 + 1)], converters),
+                            LoadCsvFiles.get_key([2 ** 53], converters))
+        self.assertEqual(LoadCsvFiles.get_key(['1', '', 'NaN'], converters),
+                         LoadCsvFiles.get_key([1, None, float('nan')], converters))
+
+    def test_plan_table_compares_by_column_type(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'Metric', [
+            SchemaMetadata.Column('MetricId', 'int', 4, 10, 0, False, False),
+            SchemaMetadata.Column('Code', 'varchar', 10, 0, 0, True, False),
+            SchemaMetadata.Column('Weight', 'float', 8, 53, 0, True, False)], ['MetricId'], False, [])
+        cursor = RecordingCursor([(1, '01234', float('nan')), (2, '01234', 1.0)])
+        plan = {}
+        LoadCsvFiles.plan_table(table_info, ['MetricId', 'Code', 'Weight'],
+                                [[['01', '01234', 'NaN'], ['2', '1234', '1']]], cursor, plan, None)
+        self.assertEqual({'inserts': 0, 'updates': 1, 'unchanged': 1}, plan['dbo.Metric'])
+
+    def test_execute_batch_uses_connection_transaction(self):
+        cursor = RecordingCursor()
+        insert = LoadCsvFiles.get_parameterized_insert_statement(['MetricId'], 'dbo', 'Metric')
+        self.assertEqual([], LoadCsvFiles.execute_batch(cursor, 'dbo', 'Metric', insert, [[1], [2]], True))
+        self.assertEqual(['SELECT TOP (0) 1 FROM dbo.Metric', 'SAVE TRANSACTION LoadCsvFilesBatch', insert],
+                         cursor.statements)
+
+    def run_data(self, table_info, headers, rows, existing_rows, key_limit):
+        # Load the rows row by row and return the key queries and the changes sent
+        literal_rows = LoadCsvFiles.convert_rows(rows, LoadCsvFiles.get_column_converters(table_info, headers, True))
+        cursor = TableCursor(existing_rows)
+        metrics = LoadCsvFiles.TableMetrics(table_info.table_name, False)
+        self.assertEqual([], LoadCsvFiles.run_data(table_info, headers, [(rows, literal_rows)], cursor, True,
+                                                   key_limit, metrics))
+        return ([statement for statement in cursor.statements if statement.startswith('SELECT')],
+                [statement for statement in cursor.statements if not statement.startswith('SELECT')])
+
+    def test_run_data_single_key(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'Metric', [
+            SchemaMetadata.Column('MetricId', 'int', 4, 10, 0, False, False),
+            SchemaMetadata.Column('Name', 'nvarchar', 100, 0, 0, True, False)], ['MetricId'], False, [])
+        rows = [['01', 'A'], ['2', 'B'], ['2', 'C']]
+        changes = ["UPDATE dbo.Metric SET Name = N'A' WHERE MetricId = 01",
+                   "INSERT INTO dbo.Metric (MetricId, Name) VALUES (2, N'B')",
+                   "UPDATE dbo.Metric SET Name = N'C' WHERE MetricId = 2"]
+        self.assertEqual((['SELECT COUNT_BIG(*) FROM dbo.Metric', 'SELECT MetricId FROM dbo.Metric'], changes),
+                         self.run_data(table_info, ['MetricId', 'Name'], rows, [(1,)], 10))
+        self.assertEqual((['SELECT COUNT_BIG(*) FROM dbo.Metric',
+                           'SELECT MetricId FROM dbo.Metric WHERE MetricId IN (01, 2, 2)'], changes),
+                         self.run_data(table_info, ['MetricId', 'Name'], rows, [(1,)], 0))
+
+    def test_run_data_composite_key(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'MetricVariant', [
+            SchemaMetadata.Column('MetricId', 'int', 4, 10, 0, False, False),
+            SchemaMetadata.Column('Code', 'varchar', 10, 0, 0, False, False),
+            SchemaMetadata.Column('Name', 'nvarchar', 100, 0, 0, True, False)], ['MetricId', 'Code'], False, [])
+        rows = [['1', '007', 'A'], ['1', '7', 'B']]
+        changes = ["UPDATE dbo.MetricVariant SET Name = N'A' WHERE MetricId = 1 AND Code = '007'",
+                   "INSERT INTO dbo.MetricVariant (MetricId, Code, Name) VALUES (1, '7', N'B')"]
+        self.assertEqual((['SELECT COUNT_BIG(*) FROM dbo.MetricVariant',
+                           'SELECT MetricId, Code FROM dbo.MetricVariant'], changes),
+                         self.run_data(table_info, ['MetricId', 'Code', 'Name'], rows, [(1, '007')], 10))
+        self.assertEqual((['SELECT COUNT_BIG(*) FROM dbo.MetricVariant',
+                           "SELECT MetricId, Code FROM dbo.MetricVariant WHERE (MetricId = 1 AND Code = '007') "
+                           "OR (MetricId = 1 AND Code = '7')"], changes),
+                         self.run_data(table_info, ['MetricId', 'Code', 'Name'], rows, [(1, '007')], 0))
+
+    def test_run_data_parameterized_without_primary_key(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'MetricLog', [
+            SchemaMetadata.Column('Message', 'nvarchar', 100, 0, 0, True, False)], [], False, [])
+        metrics = LoadCsvFiles.TableMetrics('MetricLog', False)
+        self.assertRaises(ValueError, LoadCsvFiles.run_data_parameterized, table_info, ['Message'], [[['Loaded']]],
+                          RecordingCursor(), True, None, metrics)
+
+    def test_get_column_converters(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'Metric', [
+            SchemaMetadata.Column('Code', 'varchar', 10, 0, 0, True, False),
+            SchemaMetadata.Column('Weight', 'float', 8, 53, 0, True, False),
+            SchemaMetadata.Column('Amount', 'decimal', 9, 18, 2, True, False),
+            SchemaMetadata.Column('Enabled', 'bit', 1, 1, 0, True, False),
+            SchemaMetadata.Column('Name', 'nvarchar', 100, 0, 0, True, False)], [], False, [])
+        headers = ['Code', 'Weight', 'Amount', 'Enabled', 'Name']
+        literals = LoadCsvFiles.get_column_converters(table_info, headers, True)
+        values = ['00123', 'NaN', ' 2.50', 'True', "O'Brien"]
+        self.assertEqual(["'00123'", "'NaN'", '2.50', '1', "N'O''Brien'"],
+                         [convert(item) for convert, item in zip(literals, values)])
+        self.assertEqual(['null'] * 5, [convert('') for convert in literals])
+        parameters = LoadCsvFiles.get_column_converters(table_info, headers, False)
+        values = ['00123', '1.5', '2.50', 'true', "O'Brien"]
+        self.assertEqual(['00123', 1.5, decimal.Decimal('2.50'), True, "O'Brien"],
+                         [convert(item) for convert, item in zip(parameters, values)])
+        self.assertEqual([None] * 5, [convert('') for convert in parameters])
+        self.assertEqual([False, 'yes', 'ten'],
+                         [LoadCsvFiles.get_parameter_converter('bit')('0'),
+                          LoadCsvFiles.get_parameter_converter('bit')('yes'),
+                          LoadCsvFiles.get_parameter_converter('decimal')('ten')])
+
+    def test_get_column_converters_alias_type(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'Metric', [
+            SchemaMetadata.Column('Code', 'CodeValue', 10, 0, 0, True, False, 'varchar'),
+            SchemaMetadata.Column('Rank', 'RankValue', 4, 10, 0, True, False, 'int')], ['Rank'], False, [])
+        literals = LoadCsvFiles.get_column_converters(table_info, ['Code', 'Rank'], True)
+        self.assertEqual(["'007'", '7'], [convert(item) for convert, item in zip(literals, ['007', ' 7'])])
+        parameters = LoadCsvFiles.get_column_converters(table_info, ['Code', 'Rank'], False)
+        self.assertEqual(['007', 7], [convert(item) for convert, item in zip(parameters, ['007', '7'])])
+        self.assertEqual((7,), LoadCsvFiles.get_key(['007'], LoadCsvFiles.get_key_converters(table_info, ['Rank'])))
+
+    def test_run_data_bulk_merges_last_row_of_a_key(self):
+        table_info = SchemaMetadata.TableInfo('dbo', 'Metric', [
+            SchemaMetadata.Column('MetricId', 'int', 4, 10, 0, False, False),
+            SchemaMetadata.Column('Name', 'nvarchar', 100, 0, 0, True, False)], ['MetricId'], False, [])
+        cursor = TableCursor([], actions=['INSERT', 'INSERT'])
+        metrics = LoadCsvFiles.TableMetrics('Metric', False)
+        chunks = [([['1', 'A'], ['2', 'B']], [[1, 'A'], [2, 'B']]), ([['1', 'C']], [[1, 'C']])]
+        self.assertEqual([], LoadCsvFiles.run_data_bulk(table_info, ['MetricId', 'Name'], chunks, cursor, True,
+                                                        metrics))
+        self.assertEqual([[1, 'A', 0], [2, 'B', 1], [1, 'C', 2]], cursor.parameter_rows)
+        stage, stage_insert, second_stage_insert, merge, drop = cursor.statements
+        self.assertEqual('SELECT TOP 0 MetricId, Name, CAST(0 AS BIGINT) AS LoadCsvFilesRow INTO #StageMetric '
+                         'FROM dbo.Metric UNION ALL SELECT TOP 0 MetricId, Name, 0 FROM dbo.Metric', stage)
+        self.assertEqual('INSERT INTO #StageMetric (MetricId, Name, LoadCsvFilesRow) VALUES (?, ?, ?)', stage_insert)
+        self.assertEqual(stage_insert, second_stage_insert)
+        self.assertIn('ROW_NUMBER() OVER (PARTITION BY MetricId ORDER BY LoadCsvFilesRow DESC) AS KeyRow', merge)
+        self.assertEqual('DROP TABLE #StageMetric', drop)
+        self.assertEqual((2, 0), (metrics.counts['inserted'], metrics.counts['updated']))
+
+    def test_get_merge_statement(self):
+        self.assertEqual('MERGE dbo.Metric AS target USING (SELECT MetricId, Name FROM (SELECT MetricId, Name, '
+                         'ROW_NUMBER() OVER (PARTITION BY MetricId ORDER BY LoadCsvFilesRow DESC) AS KeyRow '
+                         'FROM #Metric) AS staged WHERE KeyRow = 1) AS source ON target.MetricId = source.MetricId '
+                         'WHEN MATCHED AND EXISTS (SELECT source.Name EXCEPT SELECT target.Name) '
+                         'THEN UPDATE SET Name = source.Name WHEN NOT MATCHED BY TARGET THEN INSERT (MetricId, Name) '
+                         'VALUES (source.MetricId, source.Name) OUTPUT $action;',
+                         LoadCsvFiles.get_merge_statement(['MetricId', 'Name'], 'dbo', 'Metric', '#Metric',
+                                                          ['MetricId']))
+        self.assertEqual('MERGE dbo.Metric AS target USING (SELECT MetricId FROM (SELECT MetricId, '
+                         'ROW_NUMBER() OVER (PARTITION BY MetricId ORDER BY LoadCsvFilesRow DESC) AS KeyRow '
+                         'FROM #Metric) AS staged WHERE KeyRow = 1) AS source ON target.MetricId = source.MetricId '
+                         'WHEN NOT MATCHED BY TARGET THEN INSERT (MetricId) VALUES (source.MetricId) OUTPUT $action;',
+                         LoadCsvFiles.get_merge_statement(['MetricId'], 'dbo', 'Metric', '#Metric', ['MetricId']))
+
+    def test_get_parameterized_update_statement(self):
+        self.assertEqual('UPDATE dbo.MetricVariant SET Name = ?, Enabled = ? WHERE MetricId = ? AND VariantId = ?',
+                         LoadCsvFiles.get_parameterized_update_statement(['Name', 'Enabled'], 'dbo', 'MetricVariant',
+                                                                         ['MetricId', 'VariantId']))
+
+    def test_get_chunks_from_file_late_byte(self):
+        file = os.path.join(tempfile.mkdtemp(), 'Metric.csv')
+        with open(file, 'wb') as fp:
+            fp.write(('Name,Code\n' + 'x,y\n' * 20000 + 'café,z\n').encode('cp1252'))
+        encoding = FileReader.get_file_encoding(file)
+        self.assertEqual('utf-8-sig', encoding)
+        rows = [row for chunk in LoadCsvFiles.get_chunks_from_file(file, encoding, 1000) for row in chunk]
+        self.assertEqual((20001, ['café', 'z']), (len(rows), rows[-1]))
+
+    def test_read_ahead_raises_reader_error(self):
+        def chunks():
+            yield [['1']]
+            raise ValueError('Bad file')
+
+        reader = LoadCsvFiles.read_ahead(chunks(), 1)
+        self.assertEqual([['1']], next(reader))
+        self.assertRaises(ValueError, next, reader)
+
+    def test_validate_foreign_keys(self):
+        directory = tempfile.mkdtemp()
+        files = {}
+        for table, text in (('Metric', 'MetricId,ParentMetricId\n1,\n2,9\n'),
+                            ('MetricVariant', 'MetricVariantId,MetricId\n1,1\n2,2\n3,3\n4,\n')):
+            files[table] = os.path.join(directory, table + '.csv'), 'utf-8-sig'
+            with open(files[table][0], 'w') as fp:
+                fp.write(text)
+        metadata = {
+            'dbo.metric': SchemaMetadata.TableInfo('dbo', 'Metric', [], ['MetricId'], False, [
+                SchemaMetadata.ForeignKey('FK_Metric_Metric', ['ParentMetricId'], 'dbo', 'Metric', ['MetricId'])]),
+            'dbo.metricvariant': SchemaMetadata.TableInfo('dbo', 'MetricVariant', [], ['MetricVariantId'], False, [
+                SchemaMetadata.ForeignKey('FK_MetricVariant_Metric', ['MetricId'], 'dbo', 'Metric', ['MetricId'])])}
+        cursor = RecordingCursor([(3,)])
+
+        checks, orphans = LoadCsvFiles.validate_foreign_keys(['Metric', 'MetricVariant'], files, metadata, cursor, 1)
+        self.assertEqual(['SELECT DISTINCT MetricId FROM dbo.Metric'], cursor.statements)
+        self.assertEqual((1, [{'row': 2, 'values': ['9']}]),
+                         (orphans['FK_Metric_Metric']['rows'], orphans['FK_Metric_Metric']['examples']))
+        self.assertEqual([{'row': 2, 'values': ['2']}], orphans['FK_MetricVariant_Metric']['examples'])
+        chunks = [[['1', '1'], ['2', '2']], [['3', '3'], ['4', '']]]
+        self.assertEqual([[['1', '1']], [['3', '3'], ['4', '']]],
+                         list(LoadCsvFiles.filter_orphan_rows(chunks, checks['MetricVariant'])))
+
+    def test_load_levels_sqlite(self):
+        directory = tempfile.mkdtemp()
+        database = os.path.join(directory, 'load.db')
+        connection = sqlite3.connect(database)
+        connection.execute('CREATE TABLE Metric (MetricId INTEGER PRIMARY KEY)')
+        connection.execute('CREATE TABLE MetricVariant (MetricVariantId INTEGER PRIMARY KEY, MetricId INTEGER)')
+        connection.execute('CREATE TABLE MetadataList (MetadataListId INTEGER PRIMARY KEY)')
+        connection.commit()
+        connection.close()
+        rows = {'Metric': [(1,), (2,)], 'MetricVariant': [(1, 1), (2, 1)], 'MetadataList': [(1,), (2,)]}
+
+        def load(table, cursor):
+            parameters = ', '.join('?' for _ in rows[table][0])
+            cursor.executemany('INSERT INTO ' + table + ' VALUES (' + parameters + ')', rows[table])
+            return []
+
+        dependencies = {'Metric': set(), 'MetadataList': set(), 'MetricVariant': {'Metric'}}
+        levels, _ = LoadCsvFiles.get_load_levels(list(dependencies), dependencies)
+        pool = LoadCsvFiles.get_connection_pool(
+            lambda: sqlite3.connect(database, timeout=30, check_same_thread=False), 2)
+        failed, errors = LoadCsvFiles.load_levels(levels, dependencies, pool, load, 2, 'table')
+        LoadCsvFiles.close_connection_pool(pool, not errors)
+        self.assertEqual(({}, []), (errors, failed))
+
+        connection = sqlite3.connect(database)
+        for table in dependencies:
+            self.assertEqual(2, connection.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0])
+        connection.close()
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TestLoadCsvFiles)
+unittest.TextTestRunner(verbosity=2).run(suite)
@@ -1,10 +1,22 @@
+import csv
+import datetime
 import getopt
-import glob
+import hashlib
+import json
+import queue
+import sqlite3
 import sys
+import threading
+import time
 import pyodbc
 import os
+import SchemaMetadata
+import FileReader
+import SqlBatches
 
 level = 'warning'
+# Files that are never run
+excluded_files = ('Manifest.sql', 'PostDeployment.sql')
 
 
 class ScreenColors:
@@ -28,8 +40,27 @@ def usage():
          -d --database              Required. Database
          -u --user                  Required. User name
          -w --password              Required. Password
+         -n --parallel              Files run at the same time, each on its own connection, when they do not
+                                    depend on each other. Default 1.
+         -j --journal               SQLite file recording a hash and the outcome of each batch that ran, so later
+                                    runs skip the batches that did not change and succeeded.
+         -t --journal-table         Keep the journal in a DeploymentJournal table in the database instead.
+         -f --force                 Run every batch, even the ones the journal says already ran.
+         -a --create-or-alter       Run views, procedures, functions and triggers that already exist as CREATE OR
+                                    ALTER instead of skipping them. Needs SQL Server 2016 SP1 or later.
+         -x --no-catalog            Do not read the schemas and objects in the database first. Batches creating
+                                    objects that already exist are sent and fail instead of being skipped.
+         -c --cache                 SQLite file keeping the batches parsed from each file, so files that did not
+                                    change are not read and split again.
+         -k --clear-cache           Empty the cache before running.
+         -r --report                File for the time, rows affected and outcome of each file and batch. CSV if it
+                                    ends in .csv, otherwise JSON.
+         -o --top                   Slowest batches shown at the end. Default 10.
+         -b --baseline              JSON report of an earlier run, to show the files and batches that got slower.
     Example: RunSqlFiles -p D:\Projects\DelawareDOE\Dashboards-Plugin-EWS\Database -s . \
 -d EdFi_ -u edfiPService -w edfiPService
+    Example: RunSqlFiles -p D:\Projects\DelawareDOE\Dashboards-Plugin-EWS\Database -s . \
+-d EdFi_ -u edfiPService -w edfiPService -t
     """)
 
 
@@ -39,6 +70,17 @@ def get_args(opts):
     database = None
     user = None
     password = None
+    parallel = 1
+    journal_file = None
+    journal_table = False
+    force = False
+    create_or_alter = False
+    catalog = True
+    cache_file = None
+    clear_cache = False
+    report_file = None
+    top = 10
+    baseline_file = None
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             usage()
@@ -53,16 +95,39 @@ def get_args(opts):
             user = arg
         if opt in ('-w', '--password'):
             password = arg
-    return database, password, path, server, user
-
-
-def get_and_run_files_from_path(database, password, path, server, user):
+        if opt in ('-n', '--parallel'):
+            parallel = int(arg)
+        if opt in ('-j', '--journal'):
+            journal_file = arg
+        if opt in ('-t', '--journal-table'):
+            journal_table = True
+        if opt in ('-f', '--force'):
+            force = True
+        if opt in ('-a', '--create-or-alter'):
+            create_or_alter = True
+        if opt in ('-x', '--no-catalog'):
+            catalog = False
+        if opt in ('-c', '--cache'):
+            cache_file = arg
+        if opt in ('-k', '--clear-cache'):
+            clear_cache = True
+        if opt in ('-r', '--report'):
+            report_file = arg
+        if opt in ('-o', '--top'):
+            top = int(arg)
+        if opt in ('-b', '--baseline'):
+            baseline_file = arg
+    return database, password, path, server, user, parallel, journal_file, journal_table, force, create_or_alter, \
+        catalog, cache_file, clear_cache, report_file, top, baseline_file
+
+
+def get_and_run_files_from_path(database, password, path, server, user, parallel, journal_file=None,
+                                journal_table=False, force=False, create_or_alter=False, catalog=True, cache_file=None,
+                                clear_cache=False, report_file=None, top=10, baseline_file=None):
     # Show path
     print('Finding files in ' + path)
-    # Get any files for security, so we can apply them first
-    security_files = get_security_files_from_path(path)
-    # Get all other files
-    other_files = get_other_files_from_path(path)
+    # Get the files for security, so we can apply them first, and all other files in one walk
+    security_files, other_files = get_files_from_path(path)
 
     # Show files found
     for file in security_files + other_files:
@@ -80,86 +145,152 @@ def get_and_run_files_from_path(database, password, path, server, user):
     if response != 'Y' and response != 'y':
         return
 
-    # Connect to the database and run files
+    # Connect to the database and run files, with a pool of connections if running batches in parallel
     connection = pyodbc.connect(connection_string, autocommit=True)
     cursor = connection.cursor()
-    run_files(security_files, cursor)
-    run_files(other_files, cursor)
-
-    # Close the connection
+    pool = get_connection_pool(lambda: pyodbc.connect(connection_string, autocommit=True), parallel) \
+        if parallel > 1 else None
+    # Open the journal in the database or in its own file
+    journal = None
+    if journal_table:
+        journal = DeploymentJournal(connection, database, path, True)
+    elif journal_file is not None:
+        journal = DeploymentJournal(sqlite3.connect(journal_file), SchemaMetadata.get_cache_key(server, database),
+                                    path, False)
+    # Read the schemas and objects once, so creates of objects that exist are not sent
+    snapshot = CatalogSnapshot(cursor, create_or_alter) if catalog else None
+    # Open the cache of parsed files
+    cache = SqlBatches.BatchCache(cache_file) if cache_file is not None else None
+    if cache is not None and clear_cache:
+        cache.clear()
+    # Time every batch
+    report = DeploymentReport(path)
+    run_files(security_files, cursor, pool, parallel, journal, force, snapshot, cache, report)
+    run_files(other_files, cursor, pool, parallel, journal, force, snapshot, cache, report)
+
+    # Show the slowest batches and what got slower, and write the report
+    report.show_slowest(top)
+    if baseline_file is not None:
+        with open(baseline_file, 'r', encoding='utf-8') as fp:
+            report.show_slower_than(json.load(fp), top)
+    if report_file is not None:
+        report.write(report_file)
+
+    # Close the connections
+    if journal is not None and journal.connection is not connection:
+        journal.connection.close()
+    if cache is not None:
+        cache.close()
     connection.close()
-
-
-def get_security_files_from_path(path):
-    # Get sql files from security directory
-    name_list = glob.iglob(path + '/**/Security/*.sql', recursive=True)
-    # Convert generator to list where file name does not contain Manifest or PostDeployment and return
-    return [file for file in name_list if 'Manifest.sql' not in file
-            and 'PostDeployment.sql' not in file]
-
-
-def get_other_files_from_path(path):
-    # Get all sql files from the path
-    name_list = glob.iglob(path + '/**/*.sql', recursive=True)
-    # Convert generator to list where file name does not contain Security, Manifest or PostDeployment and return
-    return [file for file in name_list if 'Security' not in file
-            and 'Manifest.sql' not in file
-            and 'PostDeployment.sql' not in file]
-
-
-def run_files(file_names, cursor):
-    try_later = []
-    # Get scripts from files and run them
+    close_connection_pool(pool)
+
+
+def get_connection_pool(connect, size):
+    # Open a connection for each worker
+    pool = queue.Queue()
+    for _ in range(size):
+        pool.put(connect())
+    return pool
+
+
+def close_connection_pool(pool):
+    # Close every connection in the pool
+    while pool is not None and not pool.empty():
+        pool.get().close()
+
+
+def get_files_from_path(path):
+    # Walk the path once, returning the files in Security directories and the other files, each once
+    security_files = []
+    other_files = []
+    add_files_from_directory(path, '', security_files, other_files)
+    return security_files, other_files
+
+
+def add_files_from_directory(directory, relative_path, security_files, other_files):
+    # Add the files of the directory in name order, then the files of its sub-directories
+    with os.scandir(directory) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_file() and entry.name.lower().endswith('.sql') \
+                and not any(excluded in entry.name for excluded in excluded_files):
+            # Files directly in a Security directory run first. Other files with Security anywhere in their path
+            # below the root, including their own name, are not run.
+            if os.path.basename(relative_path) == 'Security':
+                security_files.append(entry.path)
+            elif 'Security' not in os.path.join(relative_path, entry.name):
+                other_files.append(entry.path)
+    for entry in entries:
+        if entry.is_dir():
+            add_files_from_directory(entry.path, os.path.join(relative_path, entry.name), security_files,
+                                     other_files)
+
+
+def run_files(file_names, cursor, pool=None, parallel=1, journal=None, force=False, snapshot=None, cache=None,
+              report=None):
+    # Get the batches from the files
+    batches = []
     for file_name in file_names:
         print(file_name)
-        try:
-            file_lines = get_lines_from_file(file_name, 'utf-8-sig')
-        except UnicodeDecodeError:
-            file_lines = get_lines_from_file(file_name, 'utf-16')
-        try_later += run_lines(cursor, file_lines)
+        # Use the batches parsed before if the file did not change, otherwise split the lines, reading the file once
+        if cache is not None:
+            file_batches = cache.get_batches(file_name)
+        else:
+            file_batches = SqlBatches.get_batches(FileReader.get_lines(file_name))
+        batches += [(file_name, script, count) for script, count in file_batches]
+
+    # Number the batches of each file for the report, then leave out the batches that already ran, unless forced
+    if report is not None:
+        report.add_batches(batches)
+    if journal is not None:
+        batches = journal.get_batches_to_run(batches, force)
+
+    # Run the batches so the objects they create come before the batches that use them,
+    # with batches that do not depend on each other at the same time if there is a pool
+    if pool is None:
+        try_later = run_batches(cursor, SqlBatches.order_batches(batches), snapshot, report)
+    else:
+        try_later = run_batches_on_pool(pool, batches, parallel, snapshot, report)
 
     # If there are any statements that failed, try them again
-    if try_later:
-        for script in try_later:
-            print('Retrying script:')
-            print(script[:500])
-            _, err = run_script(cursor, script)
-            if err:
-                print(ScreenColors.FAIL + 'Retry Failed.' + ScreenColors.END_C)
-                print(ScreenColors.FAIL + err.args[1] + ScreenColors.END_C)
-
-
-def get_lines_from_file(file, file_encoding):
-    # Open file for reading
-    with open(file, 'r', encoding=file_encoding) as fp:
-        # Get file contents
-        file_contents = fp.readlines()
-        # Convert generator to list and return
-        return list(file_contents)
-
-
-def run_lines(cursor, file_lines):
+    failed_batches = set()
+    for batch in try_later:
+        print('Retrying script:')
+        print(batch[1][:500])
+        _, err = run_script(cursor, batch[1], snapshot, report, batch, True)
+        if err:
+            print(ScreenColors.FAIL + 'Retry Failed.' + ScreenColors.END_C)
+            print(ScreenColors.FAIL + err.args[1] + ScreenColors.END_C)
+            failed_batches.add(batch)
+
+    # Record what ran in the journal
+    if journal is not None:
+        journal.record(failed_batches)
+    if snapshot is not None and snapshot.skipped:
+        print(str(snapshot.skipped) + ' batches skipped, the objects they create already exist.')
+        snapshot.skipped = 0
+
+
+def get_lines_from_file(file, file_encoding=None):
+    # Read the file once, with the encoding from its byte order mark or start unless given
+    return FileReader.get_lines(file, file_encoding)
+
+
+def run_batches(cursor, batches, snapshot=None, report=None):
     try_later = []
-    script = ''
-    # For each line from the file
-    for line in file_lines:
-        line_compare = line.lower()
-        # If line starts with go
-        if line_compare.startswith('go'):
-            # Then we have a complete script, run it
-            failed_script, e = run_script(cursor, script)
+    # For each batch, run it as many times as its GO count says
+    file_name = None
+    for batch in batches:
+        batch_file_name, script, count = batch
+        if batch_file_name != file_name:
+            file_name = batch_file_name
+            print('Running ' + file_name)
+        for _ in range(count):
+            _, e = run_script(cursor, script, snapshot, report, batch)
             # If it fails then show it and append it to try later
             if e:
                 display_error(e)
-                try_later.append(failed_script)
-            script = ''
-        else:
-            script += line
-
-    failed_script, e = run_script(cursor, script)
-    if e:
-        display_error(e)
-        try_later.append(failed_script)
+                try_later.append(batch)
     return try_later
 
 
@@ -168,24 +299,268 @@ def display_error(e):
     print(ScreenColors.FAIL + e.args[1] + ScreenColors.END_C)
 
 
-def run_script(cursor, script):
+def run_batches_on_pool(pool, batches, parallel, snapshot=None, report=None):
+    try_later = []
+    # Run the files that do not depend on each other at the same time, and show the errors of each batch
+    # with its file as the files finish
+    file_batches = SqlBatches.get_file_batches(batches)
+    for (file_name, _), results in SqlBatches.run_batches_in_parallel(
+            file_batches, lambda pooled_file: run_pooled_file(pool, pooled_file, snapshot, report), parallel,
+            SqlBatches.get_file_graph(file_batches)):
+        for batch, e in results:
+            if e:
+                print(ScreenColors.FAIL + file_name + ':' + ScreenColors.END_C)
+                display_error(e)
+                try_later.append(batch)
+    return try_later
+
+
+def run_pooled_file(pool, file_batches, snapshot=None, report=None):
+    # Run the batches of a file in order on one connection from the pool, so temp tables and SET options
+    # from one batch are still there for the next, each as many times as its GO count says
+    _, batches = file_batches
+    connection = pool.get()
+    try:
+        cursor = connection.cursor()
+        return [(batch, run_script(cursor, batch[1], snapshot, report, batch)[1])
+                for batch in batches for _ in range(batch[2])]
+    finally:
+        pool.put(connection)
+
+
+class DeploymentJournal:
+    # Records a hash and the outcome of each batch by file and batch index, so later runs skip the batches
+    # that did not change and succeeded
+
+    def __init__(self, connection, database_key, path, in_database):
+        self.connection = connection
+        self.database_key = database_key
+        self.path = path
+        self.pending = []
+        self.skipped = 0
+        if in_database:
+            self.connection.execute(
+                "IF OBJECT_ID('DeploymentJournal', 'U') IS NULL CREATE TABLE DeploymentJournal ("
+                'DatabaseKey NVARCHAR(256) NOT NULL, FileName NVARCHAR(400) NOT NULL, BatchIndex INT NOT NULL, '
+                'BatchHash CHAR(40) NOT NULL, Succeeded BIT NOT NULL, RunDate VARCHAR(32) NOT NULL, '
+                'PRIMARY KEY (DatabaseKey, FileName, BatchIndex))')
+        else:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS DeploymentJournal (DatabaseKey TEXT, FileName TEXT, BatchIndex INTEGER, '
+                'BatchHash TEXT, Succeeded INTEGER, RunDate TEXT, PRIMARY KEY (DatabaseKey, FileName, BatchIndex))')
+        self.connection.commit()
+        # Read the whole journal once
+        self.entries = {(file_name, index): (batch_hash, bool(succeeded))
+                        for file_name, index, batch_hash, succeeded in self.connection.execute(
+                            'SELECT FileName, BatchIndex, BatchHash, Succeeded FROM DeploymentJournal '
+                            'WHERE DatabaseKey = ?', (self.database_key,)).fetchall()}
+
+    def get_file_key(self, file_name):
+        # Files are recorded by their path under the deployment path, so any copy of the tree can use the journal
+        return os.path.relpath(file_name, self.path).replace(os.sep, '/')
+
+    def get_batches_to_run(self, batches, force):
+        # Number the batches of each file and leave out the ones that ran with the same text and succeeded
+        to_run = []
+        indexes = {}
+        for batch in batches:
+            file_name, script, count = batch
+            indexes[file_name] = indexes.get(file_name, -1) + 1
+            key = self.get_file_key(file_name), indexes[file_name]
+            batch_hash = hashlib.sha1((str(count) + '\x1f' + script).encode('utf-8')).hexdigest()
+            if not force and self.entries.get(key) == (batch_hash, True):
+                self.skipped += 1
+                continue
+            self.pending.append((batch, key, batch_hash))
+            to_run.append(batch)
+        if self.skipped:
+            print(str(self.skipped) + ' batches skipped, unchanged since they last ran.')
+        self.skipped = 0
+        return to_run
+
+    def record(self, failed_batches):
+        # Record the outcome of the batches that ran, where it changed
+        run_date = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+        rows = []
+        for batch, key, batch_hash in self.pending:
+            entry = batch_hash, batch not in failed_batches
+            if self.entries.get(key) != entry:
+                self.entries[key] = entry
+                rows.append((self.database_key,) + key + (batch_hash, int(entry[1]), run_date))
+        self.pending = []
+        if rows:
+            cursor = self.connection.cursor()
+            cursor.executemany('DELETE FROM DeploymentJournal '
+                               'WHERE DatabaseKey = ? AND FileName = ? AND BatchIndex = ?', [row[:3] for row in rows])
+            cursor.executemany('INSERT INTO DeploymentJournal (DatabaseKey, FileName, BatchIndex, BatchHash, '
+                               'Succeeded, RunDate) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.connection.commit()
+
+
+class CatalogSnapshot:
+    # The schemas and objects in the database, read once and kept up to date as batches create objects,
+    # so batches creating objects that already exist are skipped without a round trip
+
+    def __init__(self, cursor, create_or_alter):
+        self.create_or_alter = create_or_alter
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.names = {'schema:' + name.lower() for name, in cursor.execute('SELECT name FROM sys.schemas').fetchall()}
+        self.names.update((schema + '.' + name).lower() for schema, name in cursor.execute(
+            'SELECT s.name, o.name FROM sys.objects o JOIN sys.schemas s ON s.schema_id = o.schema_id '
+            'UNION ALL SELECT s.name, t.name FROM sys.types t JOIN sys.schemas s ON s.schema_id = t.schema_id '
+            'WHERE t.is_user_defined = 1').fetchall())
+
+    def get_script(self, script):
+        # Return the script to run, or None if everything it creates already exists
+        created = SqlBatches.get_created_objects(script)
+        with self.lock:
+            if not created or not created <= self.names:
+                return script
+            # Views, procedures, functions and triggers can be changed in place instead
+            match = SqlBatches.leading_create_pattern.match(script)
+            if self.create_or_alter and match.group(3).lower() in SqlBatches.module_types and not match.group(2):
+                return script[:match.end(1)] + ' OR ALTER' + script[match.end(1):]
+            self.skipped += 1
+            return None
+
+    def add(self, script):
+        # Remember the objects a batch created
+        created, _ = SqlBatches.get_batch_objects(script)
+        with self.lock:
+            self.names.update(created)
+
+
+class DeploymentReport:
+    # The time, rows affected and outcome of each batch that ran, by file and batch index
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.keys = {}
+
+    def add_batches(self, batches):
+        # Number the batches of each file. Entries are kept by file and index, the batch objects of this run
+        # are looked up by id while they run, so the same text twice is counted twice.
+        indexes = {}
+        self.keys = {}
+        for batch in batches:
+            file_name, script, _ = batch
+            indexes[file_name] = indexes.get(file_name, -1) + 1
+            key = os.path.relpath(file_name, self.path).replace(os.sep, '/'), indexes[file_name]
+            self.keys[id(batch)] = key
+            self.batches[key] = {'file': key[0], 'index': key[1], 'outcome': 'ok', 'seconds': 0.0, 'rows': 0,
+                                 'executions': 0, 'statement': ' '.join(script.split())[:100]}
+
+    def add(self, batch, outcome, seconds, rows, retry=False):
+        # Add a run of the batch, a failure stays until a retry succeeds
+        with self.lock:
+            entry = self.batches[self.keys[id(batch)]]
+            entry['seconds'] += seconds
+            entry['rows'] += max(rows, 0)
+            entry['executions'] += 1
+            if retry:
+                entry['outcome'] = 'failed' if outcome == 'failed' else 'retried'
+            elif outcome == 'failed' or entry['executions'] == 1:
+                entry['outcome'] = outcome
+
+    def get_batches(self):
+        # The batches that ran, the journal may have left some out
+        return sorted((entry for entry in self.batches.values() if entry['executions']),
+                      key=lambda entry: (entry['file'], entry['index']))
+
+    def get_files(self):
+        # Totals for each file
+        files = {}
+        for entry in self.get_batches():
+            file = files.setdefault(entry['file'], {'file': entry['file'], 'batches': 0, 'seconds': 0.0, 'rows': 0,
+                                                    'ok': 0, 'skipped-existing': 0, 'failed': 0, 'retried': 0})
+            file['batches'] += 1
+            file['seconds'] += entry['seconds']
+            file['rows'] += entry['rows']
+            file[entry['outcome']] += 1
+        return list(files.values())
+
+    def show_slowest(self, top):
+        # Show the batches that took the longest
+        print('Slowest batches:')
+        for entry in sorted(self.get_batches(), key=lambda entry: -entry['seconds'])[:top]:
+            print(f"    {entry['seconds']:10.3f}s  {entry['file']} #{entry['index']} {entry['outcome']}  "
+                  f"{entry['statement'][:60]}")
+
+    def show_slower_than(self, baseline, top):
+        # Show the files and batches that took longer than in the baseline report
+        baseline_files = {file['file']: file['seconds'] for file in baseline['files']}
+        baseline_batches = {(entry['file'], entry['index']): entry['seconds'] for entry in baseline['batches']}
+        changes = [(file['seconds'] - baseline_files[file['file']], file['file'], baseline_files[file['file']],
+                    file['seconds']) for file in self.get_files() if file['file'] in baseline_files]
+        changes += [(entry['seconds'] - baseline_batches[key], key[0] + ' #' + str(key[1]), baseline_batches[key],
+                     entry['seconds']) for entry in self.get_batches()
+                    for key in [(entry['file'], entry['index'])] if key in baseline_batches]
+        print('Slower than the baseline:')
+        for change, name, before, after in sorted(changes, reverse=True)[:top]:
+            if change > 0:
+                print(f'    {name}: {before:.3f}s to {after:.3f}s (+{change:.3f}s)')
+
+    def write(self, file):
+        # Write the files and batches as JSON, or as one CSV with a row for each
+        files = self.get_files()
+        batches = self.get_batches()
+        for entry in files + batches:
+            entry['seconds'] = round(entry['seconds'], 3)
+        if file.lower().endswith('.csv'):
+            columns = ['level', 'file', 'index', 'outcome', 'seconds', 'rows', 'executions', 'batches', 'ok',
+                       'skipped-existing', 'failed', 'retried', 'statement']
+            with open(file, 'w', encoding='utf-8', newline='') as fp:
+                writer = csv.DictWriter(fp, columns)
+                writer.writeheader()
+                writer.writerows(dict(entry, level='file') for entry in files)
+                writer.writerows(dict(entry, level='batch') for entry in batches)
+        else:
+            with open(file, 'w', encoding='utf-8') as fp:
+                json.dump({'path': self.path, 'files': files, 'batches': batches}, fp, indent=2)
+
+
+def run_script(cursor, script, snapshot=None, report=None, batch=None, retry=False):
     if script == '' or script.isspace():
         return '', None
 
-    # Try running script and if it fails then return the error
+    # Skip creating objects that already exist
+    if snapshot is not None:
+        script = snapshot.get_script(script)
+        if script is None:
+            if report is not None:
+                report.add(batch, 'skipped-existing', 0.0, 0, retry)
+            return '', None
+
+    # Try running script and if it fails then return the error, timing it either way
+    start = time.perf_counter()
+    outcome = 'ok'
+    rows = 0
+    result = '', None
     try:
         if level == 'verbose':
             print(script)
-        cursor.execute(script)
+        rows = cursor.execute(script).rowcount
+        if snapshot is not None:
+            snapshot.add(script)
     except (pyodbc.IntegrityError, pyodbc.ProgrammingError, pyodbc.Error) as err:
         # If the message says that the table, view, etc. already exists then ignore it
         if 'already' in err.args[1]:
-            return '', None
-        return script, err
+            if snapshot is not None:
+                snapshot.add(script)
+            outcome = 'skipped-existing'
+        else:
+            outcome = 'failed'
+            result = script, err
     except:
-        return script, sys.exc_info()[0]
+        outcome = 'failed'
+        result = script, sys.exc_info()[0]
 
-    return '', None
+    if report is not None:
+        report.add(batch, outcome, time.perf_counter() - start, rows, retry)
+    return result
 
 
 def main(argv):
@@ -193,7 +568,10 @@ def main(argv):
 
     # Get command line options
     try:
-        opts, args = getopt.getopt(argv, 'hp:s:d:u:w:', ['help', 'path=', 'server=', 'database=', 'user=', 'password='])
+        opts, args = getopt.getopt(argv, 'hp:s:d:u:w:n:j:tfaxc:kr:o:b:',
+                                   ['help', 'path=', 'server=', 'database=', 'user=', 'password=', 'parallel=',
+                                    'journal=', 'journal-table', 'force', 'create-or-alter', 'no-catalog', 'cache=',
+                                    'clear-cache', 'report=', 'top=', 'baseline='])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -204,22 +582,17 @@ def main(argv):
         sys.exit(2)
 
     # Get arguments
-    database, password, path, server, user = get_args(opts)
+    database, password, path, server, user, parallel, journal_file, journal_table, force, create_or_alter, \
+        catalog, cache_file, clear_cache, report_file, top, baseline_file = get_args(opts)
 
     # If there are any missing arguments, show usage and exit
-    if path is None or server is None or database is None or user is None or password is None:
+    if path is None or server is None or database is None or user is None or password is None or parallel < 1:
         usage()
         sys.exit(4)
 
-    # Run files from main directory
-    get_and_run_files_from_path(database, password, path, server, user)
-
-    # Get sub directories from the path
-    sub_directories = [os.path.join(path, x) for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
-
-    # For each sub-directory
-    for directory in sub_directories:
-        get_and_run_files_from_path(database, password, directory, server, user)
+    # Run the files from the path and its sub-directories, once each, on one connection
+    get_and_run_files_from_path(database, password, path, server, user, parallel, journal_file, journal_table, force,
+                                create_or_alter, catalog, cache_file, clear_cache, report_file, top, baseline_file)
 
 
 if __name__ == '__main__':
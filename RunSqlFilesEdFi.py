@@ -1,8 +1,12 @@
 import getopt
 import glob
+import queue
 import sys
 import pyodbc
 import os
+import FileReader
+import SqlBatches
+from concurrent.futures import ThreadPoolExecutor
 
 level = 'warning'
 
@@ -25,11 +29,22 @@ def usage():
          -h --help                  Display this usage message
          -p --path                  Required. Path to SQL files
          -s --server                Required. Database server
-         -d --database prefix       Required. Database prefix
+         -d --database prefix       Required unless there is a tenant file. Database prefix, or prefixes separated
+                                    by semicolons
          -u --user                  Required. User name
          -w --password              Required. Password
+         -n --parallel              Files run at the same time, each on its own connection, when they do not
+                                    depend on each other. Default 1.
+         -f --tenants               File with a database prefix on each line. Blank lines and lines starting with
+                                    # are ignored.
+         -m --max-databases         Databases deployed to at the same time, each on its own connection. Default 4.
+         -c --cache                 SQLite file keeping the batches parsed from each file, so files that did not
+                                    change are not read and split again.
+         -k --clear-cache           Empty the cache before running.
     Example: RunSqlFiles -p D:\Projects\DelawareDOE\Dashboards-Plugin-EWS\Database -s . \
 -d EdFi_ -u edfiPService -w edfiPService
+    Example: RunSqlFiles -p D:\Projects\DelawareDOE\Dashboards-Plugin-EWS\Database -s . \
+-d "District1_;District2_" -u edfiPService -w edfiPService -m 2
     """)
 
 
@@ -39,6 +54,11 @@ def get_args(opts):
     database_prefix = None
     user = None
     password = None
+    parallel = 1
+    tenant_file = None
+    max_databases = 4
+    cache_file = None
+    clear_cache = False
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             usage()
@@ -53,41 +73,77 @@ def get_args(opts):
             user = arg
         if opt in ('-w', '--password'):
             password = arg
-    return database_prefix, password, path, server, user
-
-
-def get_and_run_files_from_path(database, password, path, server, user):
-    # Show path
-    print('Finding files in ' + path)
-    # Get any files for security, so we can apply them first
-    security_files = get_security_files_from_path(path)
-    # Get all other files
-    other_files = get_other_files_from_path(path)
-
-    # Show files found
-    for file in security_files + other_files:
-        print(file)
-
-    # Build and show the connection string
+        if opt in ('-n', '--parallel'):
+            parallel = int(arg)
+        if opt in ('-f', '--tenants'):
+            tenant_file = arg
+        if opt in ('-m', '--max-databases'):
+            max_databases = int(arg)
+        if opt in ('-c', '--cache'):
+            cache_file = arg
+        if opt in ('-k', '--clear-cache'):
+            clear_cache = True
+    return database_prefix, password, path, server, user, parallel, tenant_file, max_databases, cache_file, \
+        clear_cache
+
+
+def get_prefixes(database_prefix, tenant_file):
+    # Get the database prefixes from the option and the tenant file, each once and in order
+    prefixes = database_prefix.split(';') if database_prefix is not None else []
+    if tenant_file is not None:
+        prefixes += [line for line in FileReader.get_lines(tenant_file) if not line.startswith('#')]
+    return list(dict.fromkeys(prefix.strip() for prefix in prefixes if prefix.strip()))
+
+
+def get_database_suffix(directory):
+    # The database a sub-directory is deployed to, after the prefix
+    if 'Application' in directory:
+        return 'Application'
+    elif 'DashboardDW' in directory:
+        return 'DashboardDW'
+    elif 'Dashboard' in directory:
+        return 'Dashboard'
+    return None
+
+
+def deploy_database(connect, plans, parallel):
+    # Run the parsed files on one database with its own connection, returning the batches that still failed
+    connection = connect()
+    pool = None
+    try:
+        pool = get_connection_pool(connect, parallel) if parallel > 1 else None
+        cursor = connection.cursor()
+        failed_scripts = []
+        # Run the security files first
+        for security_plan, other_plan in plans:
+            failed_scripts += run_plan(security_plan, cursor, pool, parallel)
+            failed_scripts += run_plan(other_plan, cursor, pool, parallel)
+        return failed_scripts
+    finally:
+        # Close the connections
+        connection.close()
+        close_connection_pool(pool)
+
+
+def get_connect(server, database, user, password):
+    # Return a function connecting to the database
     connection_string = 'DRIVER={SQL Server};SERVER=' + server + ';DATABASE=' + database + ';UID=' + \
                         user + ';PWD=' + password
-    print(connection_string)
+    return lambda: pyodbc.connect(connection_string, autocommit=True)
 
-    # Show file count and ask user if continue
-    file_count = len(security_files) + len(other_files)
-    response = input(str(file_count) + ' Files found to run against above database. Do you wish to continue? Y or N' +
-                     os.linesep)
-    if response != 'Y' and response != 'y':
-        return
 
-    # Connect to the database and run files
-    connection = pyodbc.connect(connection_string, autocommit=True)
-    cursor = connection.cursor()
-    run_files(security_files, cursor)
-    run_files(other_files, cursor)
+def get_connection_pool(connect, size):
+    # Open a connection for each worker
+    pool = queue.Queue()
+    for _ in range(size):
+        pool.put(connect())
+    return pool
 
-    # Close the connection
-    connection.close()
+
+def close_connection_pool(pool):
+    # Close every connection in the pool
+    while pool is not None and not pool.empty():
+        pool.get().close()
 
 
 def get_security_files_from_path(path):
@@ -107,62 +163,98 @@ def get_other_files_from_path(path):
             and 'PostDeployment.sql' not in file]
 
 
-def run_files(file_names, cursor):
-    try_later = []
-    # Get scripts from files and run them
+def run_files(file_names, cursor, pool=None, parallel=1):
+    # Parse the files and run them, returning the batches that still failed
+    return run_plan(get_plan(file_names), cursor, pool, parallel)
+
+
+def get_plan(file_names, cache=None):
+    # Get the batches from the files, with their order and dependencies, so they are parsed once for every database
+    batches = []
     for file_name in file_names:
         print(file_name)
-        try:
-            file_lines = get_lines_from_file(file_name, 'utf-8-sig')
-        except UnicodeDecodeError:
-            file_lines = get_lines_from_file(file_name, 'utf-16')
-        failed_statements = run_lines(cursor, file_lines)
-        # If there are any failed statements then add them to try-later list
-        if failed_statements:
-            try_later.append(failed_statements)
+        # Use the batches parsed before if the file did not change, otherwise split the lines, reading the file once
+        if cache is not None:
+            file_batches = cache.get_batches(file_name)
+        else:
+            file_batches = SqlBatches.get_batches(FileReader.get_lines(file_name))
+        batches += [(file_name, script, count) for script, count in file_batches]
+    file_batches = SqlBatches.get_file_batches(batches)
+    return batches, SqlBatches.order_batches(batches), file_batches, SqlBatches.get_file_graph(file_batches)
+
+
+def run_plan(plan, cursor, pool, parallel):
+    # Run the batches so the objects they create come before the batches that use them,
+    # with batches that do not depend on each other at the same time if there is a pool
+    _, ordered_batches, file_batches, graph = plan
+    if pool is None:
+        try_later = run_batches(cursor, ordered_batches)
+    else:
+        try_later = run_batches_on_pool(pool, file_batches, parallel, graph)
 
     # If there are any statements that failed, try them again
-    if try_later:
-        for script in try_later:
-            print('Retrying script:')
-            _, err = run_script(cursor, script)
-            if err:
-                print(ScreenColors.FAIL + 'Retry Failed.' + ScreenColors.END_C)
-                print(ScreenColors.FAIL + err.args[1] + ScreenColors.END_C)
+    failed_scripts = []
+    for script in try_later:
+        print('Retrying script:')
+        _, err = run_script(cursor, script)
+        if err:
+            print(ScreenColors.FAIL + 'Retry Failed.' + ScreenColors.END_C)
+            print(ScreenColors.FAIL + err.args[1] + ScreenColors.END_C)
+            failed_scripts.append(script)
+    return failed_scripts
 
 
-def get_lines_from_file(file, file_encoding):
-    # Open file for reading
-    with open(file, 'r', encoding=file_encoding) as fp:
-        # Get file contents
-        file_contents = fp.readlines()
-        # Convert generator to list and return
-        return list(file_contents)
+def get_lines_from_file(file, file_encoding=None):
+    # Read the file once, with the encoding from its byte order mark or start unless given
+    return FileReader.get_lines(file, file_encoding)
 
 
-def run_lines(cursor, file_lines):
+def run_batches(cursor, batches):
     try_later = []
-    script = ''
-    # For each line from the file
-    for line in file_lines:
-        line_compare = line.lower()
-        # If line starts with go
-        if line_compare.startswith('go'):
-            # Then we have a complete script, run it
+    # For each batch, run it as many times as its GO count says
+    file_name = None
+    for batch_file_name, script, count in batches:
+        if batch_file_name != file_name:
+            file_name = batch_file_name
+            print('Running ' + file_name)
+        for _ in range(count):
             failed_script, e = run_script(cursor, script)
             # If it fails then show it and append it to try later
             if failed_script:
                 print(ScreenColors.FAIL + 'Statement(s) failed. Saving for retry.' + ScreenColors.END_C)
                 print(ScreenColors.FAIL + e.args[1] + ScreenColors.END_C)
                 try_later.append(failed_script)
-            script = ''
-        else:
-            script += line
+    return try_later
 
-    run_script(cursor, script)
+
+def run_batches_on_pool(pool, file_batches, parallel, graph=None):
+    try_later = []
+    # Run the files that do not depend on each other at the same time, and show the errors of each batch
+    # with its file as the files finish
+    if graph is None:
+        graph = SqlBatches.get_file_graph(file_batches)
+    for (file_name, _), results in SqlBatches.run_batches_in_parallel(
+            file_batches, lambda pooled_file: run_pooled_file(pool, pooled_file), parallel, graph):
+        for failed_script, e in results:
+            if failed_script:
+                print(ScreenColors.FAIL + file_name + ': Statement(s) failed. Saving for retry.' + ScreenColors.END_C)
+                print(ScreenColors.FAIL + e.args[1] + ScreenColors.END_C)
+                try_later.append(failed_script)
     return try_later
 
 
+def run_pooled_file(pool, file_batches):
+    # Run the batches of a file in order on one connection from the pool, so temp tables and SET options
+    # from one batch are still there for the next, each as many times as its GO count says
+    _, batches = file_batches
+    connection = pool.get()
+    try:
+        cursor = connection.cursor()
+        return [run_script(cursor, script) for _, script, count in batches for _ in range(count)]
+    finally:
+        pool.put(connection)
+
+
 def run_script(cursor, script):
     if script == '' or script.isspace():
         return '', None
@@ -186,7 +278,9 @@ def main(argv):
 
     # Get command line options
     try:
-        opts, args = getopt.getopt(argv, 'hp:s:d:u:w:', ['help', 'path=', 'server=', 'database=', 'user=', 'password='])
+        opts, args = getopt.getopt(argv, 'hp:s:d:u:w:n:f:m:c:k',
+                                   ['help', 'path=', 'server=', 'database=', 'user=', 'password=', 'parallel=',
+                                    'tenants=', 'max-databases=', 'cache=', 'clear-cache'])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
@@ -197,24 +291,73 @@ def main(argv):
         sys.exit(2)
 
     # Get arguments
-    database_prefix, password, path, server, user = get_args(opts)
+    database_prefix, password, path, server, user, parallel, tenant_file, max_databases, cache_file, \
+        clear_cache = get_args(opts)
 
     # If there are any missing arguments, show usage and exit
-    if path is None or server is None or database_prefix is None or user is None or password is None:
+    if path is None or server is None or (database_prefix is None and tenant_file is None) or user is None \
+            or password is None or parallel < 1 or max_databases < 1:
         usage()
         sys.exit(4)
 
     # Get sub directories from the path
     sub_directories = [os.path.join(path, x) for x in os.listdir(path) if os.path.isdir(os.path.join(path, x))]
 
-    # For each sub-directory
+    # Open the cache of parsed files
+    cache = SqlBatches.BatchCache(cache_file) if cache_file is not None else None
+    if cache is not None and clear_cache:
+        cache.clear()
+
+    # Parse the security files and other files of each sub-directory once, by the database they are for
+    plans = {}
+    file_count = 0
     for directory in sub_directories:
-        if 'Application' in directory:
-            get_and_run_files_from_path(database_prefix + 'Application', password, directory, server, user)
-        elif 'DashboardDW' in directory:
-            get_and_run_files_from_path(database_prefix + 'DashboardDW', password, directory, server, user)
-        elif 'Dashboard' in directory:
-            get_and_run_files_from_path(database_prefix + 'Dashboard', password, directory, server, user)
+        suffix = get_database_suffix(directory)
+        if suffix is None:
+            continue
+        print('Finding files in ' + directory)
+        security_files = get_security_files_from_path(directory)
+        other_files = get_other_files_from_path(directory)
+        file_count += len(security_files) + len(other_files)
+        plans.setdefault(suffix, []).append((get_plan(security_files, cache), get_plan(other_files, cache)))
+    if cache is not None:
+        cache.close()
+
+    # Every prefix gets the files for each database
+    databases = {prefix + suffix: suffix_plans
+                 for prefix in get_prefixes(database_prefix, tenant_file) for suffix, suffix_plans in plans.items()}
+    for database in databases:
+        print(database)
+
+    # Show file and database count and ask user if continue
+    response = input(str(file_count) + ' Files found to run against ' + str(len(databases)) +
+                     ' databases on ' + server + '. Do you wish to continue? Y or N' + os.linesep)
+    if response != 'Y' and response != 'y':
+        return
+
+    # Deploy to the databases at the same time, each on its own connection
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_databases) as executor:
+        futures = {database: executor.submit(deploy_database, get_connect(server, database, user, password),
+                                             database_plans, parallel)
+                   for database, database_plans in databases.items()}
+        for database, future in futures.items():
+            try:
+                results[database] = future.result(), None
+            except Exception as e:
+                results[database] = [], e
+
+    # Show a summary for each database
+    print('Deployment summary:')
+    for database, (failed_scripts, error) in results.items():
+        if error is not None:
+            print(ScreenColors.FAIL + database + ': Failed. ' + (str(error) or type(error).__name__) +
+                  ScreenColors.END_C)
+        elif failed_scripts:
+            print(ScreenColors.WARNING + database + ': ' + str(len(failed_scripts)) + ' batches failed.' +
+                  ScreenColors.END_C)
+        else:
+            print(ScreenColors.OK_GREEN + database + ': Succeeded.' + ScreenColors.END_C)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,27 @@
+import RunSqlFiles
 import RunSqlFilesEdFi
+import json
+import os
 import pyodbc
+import sqlite3
+import tempfile
 import unittest
 
+
+class CatalogCursor:
+    def __init__(self, results):
+        self.results = results
+        self.statements = []
+        self.rowcount = -1
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        return self
+
+    def fetchall(self):
+        return self.results.pop(0) if self.results else []
+
+
 path = 'D:\Projects\DelawareDOE\Dashboards-Plugin-EWS\Database'
 
 
@@ -31,6 +51,174 @@ class TestRunSqlFiles(unittest.TestCase):
         result = RunSqlFilesEdFi.run_script(cursor, 'select * from metric.Metric')
         self.assertIsNone(result)
 
+    def test_run_files_in_parallel(self):
+        directory = tempfile.mkdtemp()
+        files = []
+        for name, text in (('Data.sql', 'INSERT INTO Metric VALUES (1)\nGO\nINSERT INTO Metric VALUES (2)\n'),
+                           ('Tables.sql', 'CREATE TABLE Metric (MetricId INT)\nGO\n'),
+                           ('Other.sql', 'CREATE TABLE MetadataList (MetadataListId INT)\n')):
+            files.append(os.path.join(directory, name))
+            with open(files[-1], 'w') as fp:
+                fp.write(text)
+        database = os.path.join(directory, 'deploy.db')
+        pool = RunSqlFilesEdFi.get_connection_pool(
+            lambda: sqlite3.connect(database, timeout=30, isolation_level=None, check_same_thread=False), 2)
+        connection = sqlite3.connect(database, isolation_level=None)
+        RunSqlFilesEdFi.run_files(files, connection.cursor(), pool, 2)
+        RunSqlFilesEdFi.close_connection_pool(pool)
+        self.assertEqual([(1,), (2,)], connection.execute('SELECT MetricId FROM Metric ORDER BY MetricId').fetchall())
+        connection.close()
+
+    def test_run_files_in_parallel_keeps_session(self):
+        directory = tempfile.mkdtemp()
+        files = []
+        for name, text in (('Tables.sql', 'CREATE TABLE Metric (MetricId INT)\n'),
+                           ('Data.sql', 'CREATE TEMP TABLE Staged (MetricId INT)\nGO\nINSERT INTO Staged VALUES (1)\n'
+                                        'GO\nINSERT INTO Metric SELECT MetricId FROM Staged\n')):
+            files.append(os.path.join(directory, name))
+            with open(files[-1], 'w') as fp:
+                fp.write(text)
+        database = os.path.join(directory, 'deploy.db')
+
+        def connect():
+            return sqlite3.connect(database, timeout=30, isolation_level=None, check_same_thread=False)
+
+        for module in (RunSqlFiles, RunSqlFilesEdFi):
+            pool = module.get_connection_pool(connect, 2)
+            connection = connect()
+            connection.execute('DROP TABLE IF EXISTS Metric')
+            module.run_files(files, connection.cursor(), pool, 2)
+            module.close_connection_pool(pool)
+            self.assertEqual([(1,)], connection.execute('SELECT MetricId FROM Metric').fetchall())
+            connection.close()
+
+    def test_get_prefixes(self):
+        tenant_file = os.path.join(tempfile.mkdtemp(), 'tenants.txt')
+        with open(tenant_file, 'w') as fp:
+            fp.write('# Districts\nDistrict2_\n\nDistrict3_\n')
+        self.assertEqual(['District1_', 'District2_', 'District3_'],
+                         RunSqlFilesEdFi.get_prefixes('District1_;District2_', tenant_file))
+
+    def test_deploy_databases_from_one_plan(self):
+        directory = tempfile.mkdtemp()
+        file = os.path.join(directory, 'Data.sql')
+        with open(file, 'w') as fp:
+            fp.write('INSERT INTO Metric VALUES (1)\nGO\n')
+        with open(os.path.join(directory, 'Metric.sql'), 'w') as fp:
+            fp.write('CREATE TABLE Metric (MetricId INT)\nGO\n')
+        plans = [(RunSqlFilesEdFi.get_plan([]),
+                  RunSqlFilesEdFi.get_plan([file, os.path.join(directory, 'Metric.sql')]))]
+        for name in ('District1_Dashboard', 'District2_Dashboard'):
+            database = os.path.join(directory, name + '.db')
+            self.assertEqual([], RunSqlFilesEdFi.deploy_database(
+                lambda: sqlite3.connect(database, isolation_level=None, check_same_thread=False), plans, 2))
+            connection = sqlite3.connect(database)
+            self.assertEqual([(1,)], connection.execute('SELECT MetricId FROM Metric').fetchall())
+            connection.close()
+
+    def test_get_files_from_path_once(self):
+        directory = tempfile.mkdtemp()
+        for name in ('Security/Roles.sql', 'Security/Manifest.sql', 'Security/Logins/Login.sql', 'Tables.sql',
+                     'Dashboard/Views.sql', 'Dashboard/Security/Users.sql', 'Dashboard/PostDeployment.sql',
+                     'Dashboard/Notes.txt'):
+            os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+            with open(os.path.join(directory, name), 'w') as fp:
+                fp.write('SELECT 1\n')
+        security_files, other_files = RunSqlFiles.get_files_from_path(directory)
+        self.assertEqual([os.path.join(directory, 'Dashboard', 'Security', 'Users.sql'),
+                          os.path.join(directory, 'Security', 'Roles.sql')], security_files)
+        self.assertEqual([os.path.join(directory, 'Tables.sql'), os.path.join(directory, 'Dashboard', 'Views.sql')],
+                         other_files)
+
+    def test_journal_skips_batches_that_ran(self):
+        directory = tempfile.mkdtemp()
+        file = os.path.join(directory, 'Metric.sql')
+        with open(file, 'w') as fp:
+            fp.write('CREATE TABLE IF NOT EXISTS Metric (MetricId INT)\nGO\nINSERT INTO Metric VALUES (1)\n')
+        connection = sqlite3.connect(os.path.join(directory, 'deploy.db'), isolation_level=None)
+        journal_connection = sqlite3.connect(os.path.join(directory, 'journal.db'))
+        for force in (False, False, True):
+            journal = RunSqlFiles.DeploymentJournal(journal_connection, 'server|database', directory, False)
+            RunSqlFiles.run_files([file], connection.cursor(), journal=journal, force=force)
+        with open(file, 'w') as fp:
+            fp.write('CREATE TABLE IF NOT EXISTS Metric (MetricId INT)\nGO\nINSERT INTO Metric VALUES (2)\n')
+        journal = RunSqlFiles.DeploymentJournal(journal_connection, 'server|database', directory, False)
+        RunSqlFiles.run_files([file], connection.cursor(), journal=journal)
+        self.assertEqual([(1,), (1,), (2,)], connection.execute('SELECT MetricId FROM Metric ORDER BY 1').fetchall())
+        self.assertEqual([('Metric.sql', 0, 1), ('Metric.sql', 1, 1)], journal_connection.execute(
+            'SELECT FileName, BatchIndex, Succeeded FROM DeploymentJournal ORDER BY 2').fetchall())
+        connection.close()
+        journal_connection.close()
+
+    def test_catalog_snapshot_skips_existing_objects(self):
+        cursor = CatalogCursor([[('dbo',), ('metric',)], [('metric', 'Metric'), ('metric', 'vMetric')]])
+        snapshot = RunSqlFiles.CatalogSnapshot(cursor, True)
+        batches = [('Tables.sql', 'CREATE TABLE metric.Metric (MetricId INT)\n', 1),
+                   ('Tables.sql', 'CREATE TABLE metric.Other (OtherId INT)\nINSERT INTO metric.Other VALUES (1)\n', 1),
+                   ('Views.sql', '-- Metric view\nCREATE VIEW metric.vMetric AS SELECT MetricId FROM metric.Metric\n',
+                    1),
+                   ('Tables.sql', 'CREATE TABLE metric.Other (OtherId INT)\n', 1)]
+        self.assertEqual([], RunSqlFiles.run_batches(cursor, batches, snapshot))
+        self.assertEqual([batches[1][1], '-- Metric view\nCREATE OR ALTER VIEW metric.vMetric AS SELECT MetricId '
+                                         'FROM metric.Metric\n'], cursor.statements[2:])
+        self.assertEqual(2, snapshot.skipped)
+
+    def test_get_files_from_path_leaves_out_security_names(self):
+        directory = tempfile.mkdtemp()
+        for name in ('Security/Roles.sql', 'Security/Logins/Logins.sql', 'Tables/SecurityAudit.sql',
+                     'Tables/Metric.sql', 'Tables/Manifest.sql'):
+            os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+            with open(os.path.join(directory, name), 'w') as fp:
+                fp.write('SELECT 1\n')
+        security_files, other_files = RunSqlFiles.get_files_from_path(directory)
+        self.assertEqual([os.path.join(directory, 'Security', 'Roles.sql')], security_files)
+        self.assertEqual([os.path.join(directory, 'Tables', 'Metric.sql')], other_files)
+
+    def test_deployment_report(self):
+        directory = tempfile.mkdtemp()
+        file = os.path.join(directory, 'Metric.sql')
+        with open(file, 'w') as fp:
+            fp.write('CREATE TABLE Metric (MetricId INT)\nGO\nINSERT INTO Metric VALUES (1)\nGO 2\n')
+        connection = sqlite3.connect(os.path.join(directory, 'deploy.db'), isolation_level=None)
+        report = RunSqlFiles.DeploymentReport(directory)
+        RunSqlFiles.run_files([file], connection.cursor(), report=report)
+        connection.close()
+        self.assertEqual([('Metric.sql', 0, 'ok', 0, 1), ('Metric.sql', 1, 'ok', 2, 2)],
+                         [(entry['file'], entry['index'], entry['outcome'], entry['rows'], entry['executions'])
+                          for entry in report.get_batches()])
+        # A failure is kept until a retry succeeds
+        batch = (os.path.join(directory, 'Other.sql'), 'SELECT 1', 1)
+        report.add_batches([batch])
+        report.add(batch, 'failed', 0.5, 0)
+        report.add(batch, 'ok', 0.5, 0, True)
+        self.assertEqual({'file': 'Other.sql', 'batches': 1, 'seconds': 1.0, 'rows': 0, 'ok': 0,
+                          'skipped-existing': 0, 'failed': 0, 'retried': 1}, report.get_files()[1])
+        for name in ('report.json', 'report.csv'):
+            report.write(os.path.join(directory, name))
+        with open(os.path.join(directory, 'report.csv'), newline='') as fp:
+            self.assertEqual(6, len(fp.readlines()))
+        with open(os.path.join(directory, 'report.json')) as fp:
+            baseline = json.load(fp)
+        self.assertEqual(['Metric.sql', 'Other.sql'], [file['file'] for file in baseline['files']])
+        report.show_slower_than(baseline, 10)
+
+    def test_deployment_report_keeps_every_run(self):
+        directory = tempfile.mkdtemp()
+        files = []
+        for name, text in (('Security/Roles.sql', 'CREATE TABLE Role (RoleId INT)\nGO\nINSERT INTO Role VALUES (1)\n'),
+                           ('Tables.sql', 'CREATE TABLE Metric (MetricId INT)\nGO\nINSERT INTO Metric VALUES (1)\n')):
+            files.append(os.path.join(directory, name))
+            os.makedirs(os.path.dirname(files[-1]), exist_ok=True)
+            with open(files[-1], 'w') as fp:
+                fp.write(text)
+        connection = sqlite3.connect(os.path.join(directory, 'deploy.db'), isolation_level=None)
+        report = RunSqlFiles.DeploymentReport(directory)
+        for file in files:
+            RunSqlFiles.run_files([file], connection.cursor(), report=report)
+        connection.close()
+        self.assertEqual([('Security/Roles.sql', 0), ('Security/Roles.sql', 1), ('Tables.sql', 0), ('Tables.sql', 1)],
+                         [(entry['file'], entry['index']) for entry in report.get_batches()])
+
 
 suite = unittest.TestLoader().loadTestsFromTestCase(TestRunSqlFiles)
 unittest.TextTestRunner(verbosity=2).run(suite)
\ No newline at end of file
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+from collections import namedtuple
+
+# The base type is the system type under an alias type, such as nvarchar for sysname, or None when it is the same
+Column = namedtuple('Column', 'name type_name max_length precision scale is_nullable is_identity base_type_name',
+                    defaults=(None,))
+ForeignKey = namedtuple('ForeignKey', 'name columns referenced_schema referenced_table referenced_columns')
+TableInfo = namedtuple('TableInfo', 'schema_name table_name columns pk_columns has_identity foreign_keys')
+
+# Schema metadata by server and database, shared by every connection in the process
+metadata_cache = {}
+metadata_lock = threading.RLock()
+
+# Columns, types, identity and primary keys, then foreign keys, for every table in one batch
+metadata_sql = '''
+SET NOCOUNT ON;
+SELECT s.name, t.name, c.name, ty.name, c.max_length, c.precision, c.scale, c.is_nullable, c.is_identity,
+    ic.key_ordinal, TYPE_NAME(c.system_type_id)
+FROM sys.tables t
+    JOIN sys.schemas s ON s.schema_id = t.schema_id
+    JOIN sys.columns c ON c.object_id = t.object_id
+    JOIN sys.types ty ON ty.user_type_id = c.user_type_id
+    LEFT JOIN sys.indexes i ON i.object_id = t.object_id AND i.is_primary_key = 1
+    LEFT JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+        AND ic.column_id = c.column_id
+ORDER BY s.name, t.name, c.column_id;
+SELECT fs.name, ft.name, fk.name, fc.name, ps.name, pt.name, pc.name
+FROM sys.foreign_keys fk
+    JOIN sys.foreign_key_columns fkc ON fkc.constraint_object_id = fk.object_id
+    JOIN sys.tables ft ON ft.object_id = fk.parent_object_id
+    JOIN sys.schemas fs ON fs.schema_id = ft.schema_id
+    JOIN sys.columns fc ON fc.object_id = fkc.parent_object_id AND fc.column_id = fkc.parent_column_id
+    JOIN sys.tables pt ON pt.object_id = fk.referenced_object_id
+    JOIN sys.schemas ps ON ps.schema_id = pt.schema_id
+    JOIN sys.columns pc ON pc.object_id = fkc.referenced_object_id AND pc.column_id = fkc.referenced_column_id
+ORDER BY fs.name, ft.name, fk.name, fkc.constraint_column_id;
+'''
+
+
+def get_cache_key(server, database):
+    # Server and database names are not case sensitive
+    return server.lower() + '|' + database.lower()
+
+
+def get_schema_metadata(cursor, server, database, cache_file=None, refresh=False):
+    # Returns table information by lower case schema.table name
+    key = get_cache_key(server, database)
+    with metadata_lock:
+        # If refreshing then forget what we have
+        if refresh:
+            invalidate(server, database, cache_file)
+
+        # Use the metadata in memory
+        if key in metadata_cache:
+            return metadata_cache[key]
+
+        # Use the metadata on disk
+        if cache_file is not None:
+            metadata = read_cache_file(cache_file).get(key)
+            if metadata is not None:
+                metadata_cache[key] = metadata = from_json(metadata)
+                return metadata
+
+        # Fetch the metadata from the database and cache it
+        metadata = fetch_schema_metadata(cursor)
+        metadata_cache[key] = metadata
+        if cache_file is not None:
+            write_cache_file(cache_file, key, metadata)
+        return metadata
+
+
+def invalidate(server, database, cache_file=None):
+    # Remove the metadata for the database from memory and from disk
+    key = get_cache_key(server, database)
+    with metadata_lock:
+        metadata_cache.pop(key, None)
+        if cache_file is not None and os.path.exists(cache_file):
+            cached = read_cache_file(cache_file)
+            if cached.pop(key, None) is not None:
+                with open(cache_file, 'w', encoding='utf-8') as fp:
+                    json.dump(cached, fp)
+
+
+def fetch_schema_metadata(cursor):
+    # Run the metadata batch
+    cursor.execute(metadata_sql)
+
+    # Build the tables from the column rows
+    tables = {}
+    pk_ordinals = {}
+    for row in cursor.fetchall():
+        schema_name, table_name, column_name, type_name, max_length, precision, scale, is_nullable, is_identity, \
+            key_ordinal, base_type_name = row
+        name = (schema_name + '.' + table_name).lower()
+        if name not in tables:
+            tables[name] = TableInfo(schema_name, table_name, [], [], False, [])
+            pk_ordinals[name] = []
+        tables[name].columns.append(
+            Column(column_name, type_name, max_length, precision, scale, bool(is_nullable), bool(is_identity),
+                   base_type_name))
+        if is_identity:
+            tables[name] = tables[name]._replace(has_identity=True)
+        if key_ordinal is not None:
+            pk_ordinals[name].append((key_ordinal, column_name))
+    for name, ordinals in pk_ordinals.items():
+        tables[name].pk_columns.extend(column_name for _, column_name in sorted(ordinals))
+
+    # Add the foreign keys from the second result set
+    cursor.nextset()
+    foreign_keys = {}
+    for schema_name, table_name, fk_name, column_name, referenced_schema, referenced_table, referenced_column \
+            in cursor.fetchall():
+        name = (schema_name + '.' + table_name).lower()
+        if (name, fk_name) not in foreign_keys:
+            foreign_keys[(name, fk_name)] = ForeignKey(fk_name, [], referenced_schema, referenced_table, [])
+            tables[name].foreign_keys.append(foreign_keys[(name, fk_name)])
+        foreign_keys[(name, fk_name)].columns.append(column_name)
+        foreign_keys[(name, fk_name)].referenced_columns.append(referenced_column)
+    return tables
+
+
+def get_table(metadata, table):
+    # Find a table by schema.table, or by table name alone in any schema
+    if '.' in table:
+        return metadata.get(table.replace('[', '').replace(']', '').lower())
+    for table_info in metadata.values():
+        if table_info.table_name.lower() == table.lower():
+            return table_info
+    return None
+
+
+def read_cache_file(cache_file):
+    # Read the cached metadata for every database, if there is any
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r', encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def write_cache_file(cache_file, key, metadata):
+    # Add the metadata for the database to the cache file
+    cached = read_cache_file(cache_file)
+    cached[key] = to_json(metadata)
+    with open(cache_file, 'w', encoding='utf-8') as fp:
+        json.dump(cached, fp)
+
+
+def to_json(metadata):
+    # Convert the named tuples to dictionaries
+    return {name: dict(table_info._asdict(),
+                       columns=[column._asdict() for column in table_info.columns],
+                       foreign_keys=[foreign_key._asdict() for foreign_key in table_info.foreign_keys])
+            for name, table_info in metadata.items()}
+
+
+def from_json(metadata):
+    # Convert the dictionaries back to named tuples
+    return {name: TableInfo(**dict(table_info,
+                                   columns=[Column(**column) for column in table_info['columns']],
+                                   foreign_keys=[ForeignKey(**foreign_key)
+                                                 for foreign_key in table_info['foreign_keys']]))
+            for name, table_info in metadata.items()}
@@ -0,0 +1,101 @@
+import SchemaMetadata
+import os
+import tempfile
+import unittest
+
+
+class MetadataCursor:
+    def __init__(self, result_sets):
+        self.result_sets = list(result_sets)
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        return self
+
+    def fetchall(self):
+        return self.result_sets[0]
+
+    def nextset(self):
+        self.result_sets.pop(0)
+        return bool(self.result_sets)
+
+
+def get_cursor():
+    # Column rows with their primary key ordinals, then foreign key rows
+    columns = [('metric', 'MetricVariant', 'MetricVariantId', 'int', 4, 10, 0, 0, 1, 2, 'int'),
+               ('metric', 'MetricVariant', 'MetricId', 'int', 4, 10, 0, 0, 0, 1, 'int'),
+               ('metric', 'MetricVariant', 'Code', 'CodeValue', 10, 0, 0, 1, 0, None, 'varchar'),
+               ('metric', 'Metric', 'MetricId', 'int', 4, 10, 0, 0, 0, 1, 'int'),
+               ('metric', 'Metric', 'ParentMetricId', 'int', 4, 10, 0, 1, 0, None, 'int')]
+    foreign_keys = [('metric', 'MetricVariant', 'FK_MetricVariant_Metric', 'MetricId', 'metric', 'Metric', 'MetricId'),
+                    ('metric', 'Metric', 'FK_Metric_Metric', 'ParentMetricId', 'metric', 'Metric', 'MetricId')]
+    return MetadataCursor([columns, foreign_keys])
+
+
+class TestSchemaMetadata(unittest.TestCase):
+    def setUp(self):
+        SchemaMetadata.metadata_cache.clear()
+
+    def test_fetch_schema_metadata(self):
+        metadata = SchemaMetadata.fetch_schema_metadata(get_cursor())
+        self.assertEqual(['metric.metricvariant', 'metric.metric'], list(metadata))
+        variant = metadata['metric.metricvariant']
+        self.assertEqual(['MetricId', 'MetricVariantId'], variant.pk_columns)
+        self.assertTrue(variant.has_identity)
+        self.assertFalse(metadata['metric.metric'].has_identity)
+        self.assertEqual(SchemaMetadata.Column('Code', 'CodeValue', 10, 0, 0, True, False, 'varchar'),
+                         variant.columns[2])
+        self.assertEqual([SchemaMetadata.ForeignKey('FK_MetricVariant_Metric', ['MetricId'], 'metric', 'Metric',
+                                                    ['MetricId'])], variant.foreign_keys)
+        self.assertEqual(['FK_Metric_Metric'], [foreign_key.name for foreign_key in
+                                                metadata['metric.metric'].foreign_keys])
+
+    def test_composite_foreign_key(self):
+        columns = [('dbo', 'Child', 'A', 'int', 4, 10, 0, 0, 0, None, 'int'),
+                   ('dbo', 'Child', 'B', 'int', 4, 10, 0, 0, 0, None, 'int'),
+                   ('dbo', 'Parent', 'A', 'int', 4, 10, 0, 0, 0, 1, 'int'),
+                   ('dbo', 'Parent', 'B', 'int', 4, 10, 0, 0, 0, 2, 'int')]
+        foreign_keys = [('dbo', 'Child', 'FK_Child_Parent', 'A', 'dbo', 'Parent', 'A'),
+                        ('dbo', 'Child', 'FK_Child_Parent', 'B', 'dbo', 'Parent', 'B')]
+        metadata = SchemaMetadata.fetch_schema_metadata(MetadataCursor([columns, foreign_keys]))
+        self.assertEqual([SchemaMetadata.ForeignKey('FK_Child_Parent', ['A', 'B'], 'dbo', 'Parent', ['A', 'B'])],
+                         metadata['dbo.child'].foreign_keys)
+        self.assertEqual([], metadata['dbo.child'].pk_columns)
+
+    def test_cache_file_round_trip(self):
+        cache_file = os.path.join(tempfile.mkdtemp(), 'metadata.json')
+        metadata = SchemaMetadata.get_schema_metadata(get_cursor(), 'Server', 'EdFi_Dashboard', cache_file)
+        SchemaMetadata.metadata_cache.clear()
+
+        # The metadata comes back from the file without a query
+        cursor = MetadataCursor([])
+        self.assertEqual(metadata, SchemaMetadata.get_schema_metadata(cursor, 'server', 'edfi_dashboard', cache_file))
+        self.assertEqual([], cursor.statements)
+
+        # Invalidating removes it from memory and from the file, so it is fetched again
+        SchemaMetadata.invalidate('SERVER', 'EdFi_Dashboard', cache_file)
+        self.assertEqual({}, SchemaMetadata.read_cache_file(cache_file))
+        cursor = get_cursor()
+        self.assertEqual(metadata, SchemaMetadata.get_schema_metadata(cursor, 'Server', 'EdFi_Dashboard', cache_file))
+        self.assertEqual([SchemaMetadata.metadata_sql], cursor.statements)
+
+    def test_cache_file_without_base_type(self):
+        metadata = SchemaMetadata.fetch_schema_metadata(get_cursor())
+        cached = SchemaMetadata.to_json(metadata)
+        for table_info in cached.values():
+            for column in table_info['columns']:
+                del column['base_type_name']
+        self.assertIsNone(SchemaMetadata.from_json(cached)['metric.metricvariant'].columns[2].base_type_name)
+
+    def test_get_table(self):
+        metadata = SchemaMetadata.fetch_schema_metadata(get_cursor())
+        self.assertEqual('MetricVariant', SchemaMetadata.get_table(metadata, 'metric.MetricVariant').table_name)
+        self.assertEqual('MetricVariant', SchemaMetadata.get_table(metadata, '[metric].[MetricVariant]').table_name)
+        self.assertEqual('Metric', SchemaMetadata.get_table(metadata, 'METRIC').table_name)
+        self.assertIsNone(SchemaMetadata.get_table(metadata, 'dbo.Metric'))
+        self.assertIsNone(SchemaMetadata.get_table(metadata, 'MetadataList'))
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TestSchemaMetadata)
+unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,298 @@
+import hashlib
+import heapq
+import json
+import os
+import re
+import sqlite3
+import FileReader
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# A GO separator on its own line, with an optional repeat count and trailing comment.
+# Only lines starting with one of the separator starts are matched against it.
+separator_starts = frozenset('gG \t')
+separator_pattern = re.compile(r'^\s*go(?:\s+(\d+))?\s*(?:--.*)?$', re.IGNORECASE)
+# Text outside comments, strings and bracketed identifiers, taking whole line comments, strings and identifiers.
+# It stops at the start of a block comment or at a string or identifier that is not closed yet.
+normal_pattern = re.compile(r"""(?:[^'"\[/-]+|/(?!\*)|-(?!-)|--[^\n]*"""
+                            r"""|'[^']*(?:''[^']*)*'|"[^"]*(?:""[^"]*)*"|\[[^\]]*(?:\]\][^\]]*)*\])*""")
+comment_pattern = re.compile(r'/\*|\*/')
+# The rest of a string or identifier that is already open
+end_patterns = {"'": re.compile(r"[^']*(?:''[^']*)*'"), '"': re.compile(r'[^"]*(?:""[^"]*)*"'),
+                '[': re.compile(r'[^\]]*(?:\]\][^\]]*)*\]')}
+# Comments and strings, which are left out when finding the objects in a batch
+ignored_pattern = re.compile(r"--[^\n]*|/\*.*?\*/|'[^']*(?:''[^']*)*'", re.DOTALL)
+# A one to three part name, each part plain, bracketed or quoted
+name_pattern = r'(?:\[[^\]]+\]|"[^"]+"|[\w@#$]+)(?:\s*\.\s*(?:\[[^\]]+\]|"[^"]+"|[\w@#$]+)){0,2}'
+name_part_pattern = re.compile(r'\[[^\]]+\]|"[^"]+"|[\w@#$]+')
+create_schema_pattern = re.compile(r'\bcreate\s+schema\s+(' + name_pattern + ')', re.IGNORECASE)
+create_pattern = re.compile(
+    r'\bcreate\s+(?:or\s+alter\s+)?(?:table|view|procedure|proc|function|trigger|synonym|type)\s+(' +
+    name_pattern + ')', re.IGNORECASE)
+# The CREATE a batch starts with, after any comments
+leading_create_pattern = re.compile(
+    r'(?:\s+|--[^\n]*|/\*.*?\*/)*(create)\s+(?:(or\s+alter)\s+)?'
+    r'(schema|table|view|procedure|proc|function|trigger|synonym|type)\s+(' + name_pattern + ')',
+    re.IGNORECASE | re.DOTALL)
+# Objects that have to be the only statement in their batch and can be created or altered
+module_types = frozenset(('view', 'procedure', 'proc', 'function', 'trigger'))
+# Words that start a statement other than CREATE, so a batch using them does more than create objects
+statement_pattern = re.compile(
+    r'\b(?:insert|update|delete|merge|exec|execute|alter|drop|grant|deny|revoke|select|set|declare|if|while|begin|'
+    r'print|truncate|use|dbcc|enable|disable|bulk|raiserror|throw|return)\b', re.IGNORECASE)
+# Parentheses with nothing parenthesized inside, removed until none are left
+parentheses_pattern = re.compile(r'\([^()]*\)')
+reference_pattern = re.compile(
+    r'\b(?:from|join|references|exec|execute|insert\s+into|insert|update|'
+    r'alter\s+(?:table|view|procedure|proc|function))\s+(' + name_pattern + ')', re.IGNORECASE)
+
+
+def get_batches(lines):
+    # Yield each batch with its GO repeat count, reading the lines as they are needed
+    buffer = []
+    scanned = 0
+    state = None
+    for line in lines:
+        match = separator_pattern.match(line) if line[:1] in separator_starts else None
+        if match:
+            # GO only separates batches when it is not inside a comment, string or bracketed identifier,
+            # so find where the lines since the last separator leave off
+            state = scan_text(''.join(buffer[scanned:]), state)
+            scanned = len(buffer)
+            if state is None:
+                batch = ''.join(buffer)
+                buffer = []
+                scanned = 0
+                if batch.strip():
+                    yield batch, int(match.group(1) or 1)
+                continue
+        buffer.append(line)
+
+    # The last batch does not need a GO
+    batch = ''.join(buffer)
+    if batch.strip():
+        yield batch, 1
+
+
+def scan_text(text, state):
+    # Return the state at the end of the text: None, a block comment depth, or the opening quote or bracket
+    position = 0
+    while True:
+        if state is None:
+            position = normal_pattern.match(text, position).end()
+            if position == len(text):
+                return None
+            # Either a block comment starts or a string or identifier is left open
+            if text.startswith('/*', position):
+                state = 1
+                position += 2
+            else:
+                state = text[position]
+                position += 1
+        elif isinstance(state, int):
+            # Block comments can be nested
+            match = comment_pattern.search(text, position)
+            if match is None:
+                return state
+            state = state + 1 if match.group() == '/*' else state - 1 or None
+            position = match.end()
+        else:
+            # A doubled quote or bracket is an escape, not the end
+            match = end_patterns[state].match(text, position)
+            if match is None:
+                return state
+            state = None
+            position = match.end()
+
+
+def get_batch_objects(batch):
+    # Return the objects a batch creates and the objects it references, as lower case schema.name
+    text = ignored_pattern.sub(' ', batch)
+    created = {'schema:' + get_name_parts(name)[-1] for name in create_schema_pattern.findall(text)}
+    created.update(get_object_name(name) for name in create_pattern.findall(text))
+    referenced = {get_object_name(name) for name in reference_pattern.findall(text) if not name.startswith('#')}
+    # An object also needs its schema
+    referenced.update('schema:' + name.split('.')[0] for name in created | referenced if not name.startswith('schema:'))
+    return created, referenced - created
+
+
+def get_created_objects(batch):
+    # Return the objects a batch creates when creating them is all it does, otherwise None.
+    # A view, procedure, function or trigger is the whole batch, other batches must not use what they create.
+    match = leading_create_pattern.match(batch)
+    if match is None:
+        return None
+    if match.group(3).lower() in module_types:
+        return {get_object_name(match.group(4))}
+    # Leave out comments, strings and what is in parentheses, such as columns and constraints,
+    # then every statement has to be a CREATE of a schema, table, synonym or type and nothing else
+    text = ignored_pattern.sub(' ', batch)
+    count = 1
+    while count:
+        text, count = parentheses_pattern.subn(' ', text)
+    for statement in re.split(r'(?=\bcreate\b)', text, flags=re.IGNORECASE):
+        if not statement.strip() or statement.strip() == ';':
+            continue
+        match = leading_create_pattern.match(statement)
+        if match is None or match.group(3).lower() in module_types or statement_pattern.search(statement, match.end()):
+            return None
+    created, _ = get_batch_objects(batch)
+    if any(name.split('.')[-1].startswith('#') for name in created):
+        return None
+    return created
+
+
+def get_name_parts(name):
+    # Split a possibly bracketed or quoted multi-part name
+    return [part.strip().strip('[]"').lower() for part in name_part_pattern.findall(name)]
+
+
+def get_object_name(name):
+    # Objects without a schema are in dbo, and the server and database parts are not needed
+    parts = get_name_parts(name)
+    return '.'.join((['dbo'] + parts)[-2:])
+
+
+def get_batch_graph(batches):
+    # Make each (file, batch, count) depend on the batches creating the objects it references,
+    # and on the batch before it in the same file. Returns the dependents of each batch
+    # and the number of batches each one waits for.
+    objects = [get_batch_objects(batch) for _, batch, _ in batches]
+    creators = {}
+    for index, (created, _) in enumerate(objects):
+        for name in created:
+            creators.setdefault(name, index)
+
+    # Build the graph from each batch to the batches that need it
+    dependents = [[] for _ in batches]
+    waiting = [0] * len(batches)
+    previous = {}
+    for index, ((file, _, _), (_, referenced)) in enumerate(zip(batches, objects)):
+        parents = {creators[name] for name in referenced if name in creators} - {index}
+        if file in previous:
+            parents.add(previous[file])
+        previous[file] = index
+        for parent in parents:
+            dependents[parent].append(index)
+            waiting[index] += 1
+    return dependents, waiting
+
+
+def get_file_batches(batches):
+    # Group the (file, batch, count) of each file in order, keeping the files in the order of their first batch
+    files = {}
+    for batch in batches:
+        files.setdefault(batch[0], []).append(batch)
+    return list(files.items())
+
+
+def get_file_graph(file_batches):
+    # Make each file depend on the files creating the objects its batches reference,
+    # so a file's batches can run in order on one connection
+    return get_batch_graph([(file, '\n'.join(script for _, script, _ in batches), 1)
+                            for file, batches in file_batches])
+
+
+def order_batches(batches):
+    # Order the batches so objects are created before the batches that reference them,
+    # keeping the batches of each file in order
+    dependents, waiting = get_batch_graph(batches)
+
+    # Take the batches that are ready in their original order
+    ready = [index for index, count in enumerate(waiting) if not count]
+    order = []
+    while ready:
+        index = heapq.heappop(ready)
+        order.append(index)
+        for dependent in dependents[index]:
+            waiting[dependent] -= 1
+            if not waiting[dependent]:
+                heapq.heappush(ready, dependent)
+
+    # Batches in a cycle keep their original order and are left to the retry
+    ordered = set(order)
+    order += [index for index in range(len(batches)) if index not in ordered]
+    return [batches[index] for index in order]
+
+
+def run_batches_in_parallel(batches, run_batch, workers, graph=None):
+    # Run each batch once the batches it depends on have finished, at most workers at a time,
+    # and yield each batch with what run_batch returned as they finish.
+    # The graph can be built once with get_batch_graph and used for many runs.
+    dependents, waiting = graph if graph is not None else get_batch_graph(batches)
+    waiting = list(waiting)
+    ready = [index for index, count in enumerate(waiting) if not count]
+    finished = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        while ready or running:
+            while ready:
+                index = heapq.heappop(ready)
+                running[executor.submit(run_batch, batches[index])] = index
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                finished.add(index)
+                yield batches[index], future.result()
+                # A failed batch still releases the batches after it, they are retried at the end if they fail too
+                for dependent in dependents[index]:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        heapq.heappush(ready, dependent)
+
+    # Batches in a cycle run one at a time in their original order and are left to the retry
+    for index in range(len(batches)):
+        if index not in finished:
+            yield batches[index], run_batch(batches[index])
+
+
+class BatchCache:
+    # The batches parsed from each file, kept in a SQLite file by path with the file's size, modified time
+    # and content hash, so files that did not change are not read, decoded and split again
+
+    def __init__(self, file):
+        self.connection = sqlite3.connect(file)
+        self.hits = 0
+        self.misses = 0
+        self.connection.execute('CREATE TABLE IF NOT EXISTS ParsedFile (FileName TEXT PRIMARY KEY, FileSize INTEGER, '
+                                'ModifiedTime INTEGER, FileHash TEXT, Encoding TEXT, Batches TEXT)')
+        self.connection.commit()
+
+    def clear(self):
+        # Forget every parsed file
+        self.connection.execute('DELETE FROM ParsedFile')
+        self.connection.commit()
+
+    def get_batches(self, file_name):
+        # Return the (batch, count) pairs of the file, parsing it only if it changed
+        key = os.path.abspath(file_name)
+        stat = os.stat(file_name)
+        row = self.connection.execute('SELECT FileSize, ModifiedTime, FileHash, Batches FROM ParsedFile '
+                                      'WHERE FileName = ?', (key,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            self.hits += 1
+            return [tuple(batch) for batch in json.loads(row[3])]
+
+        # A file that was only touched, by a checkout for example, still has the same hash
+        with open(file_name, 'rb') as fp:
+            data = fp.read()
+        file_hash = hashlib.sha1(data).hexdigest()
+        if row is not None and row[2] == file_hash:
+            self.hits += 1
+            self.connection.execute('UPDATE ParsedFile SET FileSize = ?, ModifiedTime = ? WHERE FileName = ?',
+                                    (stat.st_size, stat.st_mtime_ns, key))
+            return [tuple(batch) for batch in json.loads(row[3])]
+
+        # Parse the bytes already read and remember the batches
+        self.misses += 1
+        encoding = FileReader.get_data_encoding(data)
+        batches = list(get_batches(FileReader.decode_lines(data, encoding)))
+        self.connection.execute('INSERT OR REPLACE INTO ParsedFile (FileName, FileSize, ModifiedTime, FileHash, '
+                                'Encoding, Batches) VALUES (?, ?, ?, ?, ?, ?)',
+                                (key, stat.st_size, stat.st_mtime_ns, file_hash, encoding, json.dumps(batches)))
+        return batches
+
+    def close(self):
+        # Save the parsed files and show how many were found
+        print('Batch cache: ' + str(self.hits) + ' files found, ' + str(self.misses) + ' files parsed.')
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,91 @@
+import SqlBatches
+import os
+import tempfile
+import unittest
+
+
+def get_batches(script):
+    return list(SqlBatches.get_batches(script.splitlines(keepends=True)))
+
+
+class TestSqlBatches(unittest.TestCase):
+    def test_split_on_go(self):
+        self.assertEqual([('SELECT 1\n', 1), ('SELECT 2\n', 1)], get_batches('SELECT 1\nGO\nSELECT 2\n'))
+
+    def test_go_count_and_comment(self):
+        self.assertEqual([('INSERT dbo.Log DEFAULT VALUES\n', 3), ('SELECT 1\n', 1)],
+                         get_batches('INSERT dbo.Log DEFAULT VALUES\n  go 3 -- three rows\nSELECT 1\n'))
+
+    def test_lines_starting_with_go_are_not_separators(self):
+        script = 'WHILE 1 = 1\nGOTO Done\ngovernment_id INT,\nGO\n'
+        self.assertEqual([('WHILE 1 = 1\nGOTO Done\ngovernment_id INT,\n', 1)], get_batches(script))
+
+    def test_go_inside_string_comment_and_brackets(self):
+        script = ("SELECT 'a\nGO\nb'\n/* outer /* inner */\nGO\n*/\nSELECT [x\nGO\n]]y]\nGO\n"
+                  "-- it's a comment\nSELECT 'it''s'\nGO\n")
+        self.assertEqual(
+            [("SELECT 'a\nGO\nb'\n/* outer /* inner */\nGO\n*/\nSELECT [x\nGO\n]]y]\n", 1),
+             ("-- it's a comment\nSELECT 'it''s'\n", 1)],
+            get_batches(script))
+
+    def test_empty_batches_are_skipped(self):
+        self.assertEqual([('SELECT 1', 1)], get_batches('GO\n\nGO\nSELECT 1'))
+
+    def test_get_batch_objects(self):
+        created, referenced = SqlBatches.get_batch_objects(
+            "CREATE VIEW [metric].[vMetric] AS SELECT * FROM metric.Metric m JOIN Other o ON 1 = 1 -- FROM x.y\n"
+            "WHERE m.Name <> 'FROM a.b'")
+        self.assertEqual({'metric.vmetric'}, created)
+        self.assertEqual({'metric.metric', 'dbo.other', 'schema:metric', 'schema:dbo'}, referenced)
+
+    def test_get_created_objects(self):
+        self.assertEqual({'metric.vmetric'}, SqlBatches.get_created_objects(
+            '/* View */\nCREATE VIEW metric.vMetric AS SELECT * FROM metric.Metric'))
+        self.assertEqual({'dbo.a', 'dbo.b'}, SqlBatches.get_created_objects(
+            'CREATE TABLE A (AId INT PRIMARY KEY)\nCREATE TABLE B (AId INT REFERENCES A (AId))'))
+        self.assertIsNone(SqlBatches.get_created_objects('CREATE TABLE A (AId INT)\nINSERT INTO A VALUES (1)'))
+        self.assertIsNone(SqlBatches.get_created_objects('SELECT 1'))
+        self.assertIsNone(SqlBatches.get_created_objects(
+            'CREATE TABLE dbo.Metric (MetricId INT)\nCREATE INDEX IX_Metric ON dbo.Metric (MetricId)'))
+        self.assertIsNone(SqlBatches.get_created_objects(
+            'CREATE TABLE dbo.Metric (MetricId INT)\nGRANT SELECT ON dbo.Metric TO Reader'))
+        self.assertEqual({'dbo.m', 'dbo.metric', 'schema:metric'}, SqlBatches.get_created_objects(
+            'CREATE SCHEMA metric;\nCREATE TABLE dbo.Metric (MetricId INT, CONSTRAINT PK_Metric PRIMARY KEY '
+            '(MetricId)) ON [PRIMARY];\nCREATE SYNONYM dbo.M FOR dbo.Metric'))
+
+    def test_order_batches(self):
+        batches = [('Views.sql', 'CREATE VIEW metric.vMetric AS SELECT * FROM metric.Metric', 1),
+                   ('Tables.sql', 'CREATE TABLE metric.Metric (MetricId INT)', 1),
+                   ('Tables.sql', 'CREATE INDEX IX_Metric ON metric.Metric (MetricId)', 1),
+                   ('Schemas.sql', 'CREATE SCHEMA metric', 1),
+                   ('Other.sql', 'SELECT 1', 1)]
+        self.assertEqual([batches[index] for index in (3, 1, 0, 2, 4)], SqlBatches.order_batches(batches))
+
+    def test_order_batches_cycle_keeps_order(self):
+        batches = [('A.sql', 'CREATE TABLE dbo.A (BId INT REFERENCES dbo.B (BId))', 1),
+                   ('B.sql', 'CREATE TABLE dbo.B (AId INT REFERENCES dbo.A (AId))', 1)]
+        self.assertEqual(batches, SqlBatches.order_batches(batches))
+
+    def test_batch_cache(self):
+        directory = tempfile.mkdtemp()
+        file = os.path.join(directory, 'Tables.sql')
+        with open(file, 'w', encoding='utf-16') as fp:
+            fp.write('CREATE TABLE A (AId INT)\nGO 2\nSELECT 1\n')
+        cache = SqlBatches.BatchCache(os.path.join(directory, 'cache.db'))
+        expected = [('CREATE TABLE A (AId INT)\n', 2), ('SELECT 1\n', 1)]
+        self.assertEqual(expected, cache.get_batches(file))
+        self.assertEqual(expected, cache.get_batches(file))
+        # Touching the file keeps the batches, changing it parses it again
+        os.utime(file, ns=(0, 0))
+        self.assertEqual(expected, cache.get_batches(file))
+        with open(file, 'w', encoding='utf-16') as fp:
+            fp.write('SELECT 2\n')
+        self.assertEqual([('SELECT 2\n', 1)], cache.get_batches(file))
+        cache.clear()
+        self.assertEqual([('SELECT 2\n', 1)], cache.get_batches(file))
+        self.assertEqual((2, 3), (cache.hits, cache.misses))
+        cache.close()
+
+
+suite = unittest.TestLoader().loadTestsFromTestCase(TestSqlBatches)
+unittest.TextTestRunner(verbosity=2).run(suite)